@@ -0,0 +1,259 @@
+import functools
+import hashlib
+import json
+import math
+import os
+import threading
+from dataclasses import asdict, fields
+from typing import List, Optional
+
+from flask import Blueprint, abort, make_response, request
+from werkzeug.exceptions import HTTPException
+import numpy as np
+
+from density import DENSITY_CACHE_PATH
+from density_formula import (
+    INPUT_COLUMNS,
+    DensificationFormula,
+    density_arrays,
+    new_homes_for_formulas,
+)
+from density_store import DensityStore, StoreVersionError
+from map_artifact import source_fingerprint
+
+api = Blueprint("api", __name__, url_prefix="/api")
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# How many distinct responses to keep in memory
+RESPONSE_CACHE_SIZE = 512
+# How many what-if scenarios to remember
+WHAT_IF_CACHE_SIZE = 1024
+
+
+def _json_value(value):
+    # JSON has no nan or inf, which the formula gives for areas with no dwellings
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+# Every MSOA's figures, worked out once when the cache changes, so requests only
+# have to filter and page through them
+class MsoaIndex:
+    def __init__(self, store: DensityStore, fingerprint: str):
+        self.store = store
+        self.fingerprint = fingerprint
+        columns = store.scalars()
+        derived = density_arrays(columns)
+        # The formula's inputs as arrays, for recalculating what-if scenarios
+        self.inputs = {name: np.asarray(columns[name]) for name in INPUT_COLUMNS}
+        self.codes = np.array(columns["msoa_code"], dtype=str)
+        self.bounds = np.column_stack(
+            [columns[name] for name in ["min_lon", "min_lat", "max_lon", "max_lat"]]
+        )
+        self.records = [
+            {
+                "msoa_code": columns["msoa_code"][i],
+                "msoa_name": columns["msoa_name"][i],
+                "population": columns["population"][i],
+                "dwellings": columns["total_dwellings"][i],
+                "detached_or_semi": columns["detached_or_semi"][i],
+                "urban_area": columns["urban_area"][i],
+                "building_coverage_area": columns["building_coverage_area"][i],
+                "bbox": self.bounds[i].tolist(),
+                **{
+                    name: _json_value(float(values[i]))
+                    for name, values in derived.items()
+                },
+            }
+            for i in range(len(self.codes))
+        ]
+        self.by_code = {record["msoa_code"]: record for record in self.records}
+        self.total_new_homes = float(np.nansum(derived["new_homes"]))
+
+    def matching(self, prefix: str, bbox: Optional[List[float]]) -> np.ndarray:
+        mask = np.char.startswith(self.codes, prefix)
+        if bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            mask &= (
+                (self.bounds[:, 0] <= max_lon)
+                & (self.bounds[:, 2] >= min_lon)
+                & (self.bounds[:, 1] <= max_lat)
+                & (self.bounds[:, 3] >= min_lat)
+            )
+        return np.flatnonzero(mask)
+
+
+_index: Optional[MsoaIndex] = None
+_index_lock = threading.Lock()
+
+
+# 503 until the density cache has been built, or rebuilt if it's from an older
+# version of the store
+def current_index() -> MsoaIndex:
+    global _index
+    try:
+        fingerprint = source_fingerprint(DENSITY_CACHE_PATH)
+    except FileNotFoundError:
+        abort(503, "The density cache hasn't been built yet")
+    with _index_lock:
+        if _index is None or _index.fingerprint != fingerprint:
+            try:
+                _index = MsoaIndex(DensityStore(DENSITY_CACHE_PATH), fingerprint)
+            except StoreVersionError as error:
+                abort(503, str(error))
+        return _index
+
+
+def _parse_bbox(value: Optional[str]) -> Optional[List[float]]:
+    if value is None:
+        return None
+    try:
+        bbox = [float(part) for part in value.split(",")]
+    except ValueError:
+        abort(400, "bbox must be min_lon,min_lat,max_lon,max_lat")
+    if len(bbox) != 4:
+        abort(400, "bbox must be min_lon,min_lat,max_lon,max_lat")
+    return bbox
+
+
+# Keyed on the cache fingerprint too, so responses for an old cache are never
+# served, and simply fall out of the LRU
+@functools.lru_cache(maxsize=RESPONSE_CACHE_SIZE)
+def _cached_body(fingerprint: str, endpoint: str, arguments: tuple) -> Optional[bytes]:
+    index = current_index()
+    args = dict(arguments)
+
+    if endpoint == "summary":
+        body = {
+            "msoa_count": len(index.records),
+            "total_new_homes": index.total_new_homes,
+            "total_dwellings": sum(r["dwellings"] for r in index.records),
+            "total_population": sum(r["population"] for r in index.records),
+        }
+    elif endpoint == "msoa":
+        record = index.by_code.get(args["code"])
+        if record is None:
+            return None
+        body = dict(record)
+        if args.get("geometry"):
+            body["geojson"] = index.store.geojson(args["code"])
+    else:
+        matching = index.matching(args["prefix"], args["bbox"])
+        start = (args["page"] - 1) * args["per_page"]
+        page = matching[start : start + args["per_page"]]
+        body = {
+            "total": len(matching),
+            "page": args["page"],
+            "per_page": args["per_page"],
+            "msoas": [index.records[i] for i in page],
+        }
+
+    return json.dumps(body, separators=(",", ":")).encode("utf-8")
+
+
+def _json_response(endpoint: str, **arguments):
+    index = current_index()
+    # Lists can't be hashed, so turn the bbox into a tuple
+    key = tuple(
+        sorted(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in arguments.items()
+        )
+    )
+    body = _cached_body(index.fingerprint, endpoint, key)
+    if body is None:
+        abort(404)
+
+    response = make_response(body)
+    response.content_type = "application/json"
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@api.route("/msoas")
+def msoas():
+    page = request.args.get("page", 1, type=int)
+    per_page = request.args.get("per_page", DEFAULT_PAGE_SIZE, type=int)
+    if page < 1 or not 1 <= per_page <= MAX_PAGE_SIZE:
+        abort(400, f"page must be at least 1 and per_page from 1 to {MAX_PAGE_SIZE}")
+    return _json_response(
+        "msoas",
+        prefix=request.args.get("prefix", ""),
+        bbox=_parse_bbox(request.args.get("bbox")),
+        page=page,
+        per_page=per_page,
+    )
+
+
+@api.route("/msoas/<code>")
+def msoa(code):
+    geometry = request.args.get("geometry", "false").lower() in ("1", "true", "yes")
+    return _json_response("msoa", code=code, geometry=geometry)
+
+
+@functools.lru_cache(maxsize=WHAT_IF_CACHE_SIZE)
+def _what_if_body(fingerprint: str, formula: DensificationFormula) -> bytes:
+    index = current_index()
+    new_homes = new_homes_for_formulas(index.inputs, [formula])[0]
+    body = {
+        "formula": asdict(formula),
+        "total_new_homes": float(np.nansum(new_homes)),
+        "msoas": {
+            code: _json_value(float(value))
+            for code, value in zip(index.codes.tolist(), new_homes)
+        },
+    }
+    return json.dumps(body, separators=(",", ":")).encode("utf-8")
+
+
+# Recalculates new homes for every MSOA with a different version of the formula,
+# e.g. /api/whatif?coverage_bonus=1.2&high_family_threshold=0.5. Any parameter
+# not given keeps its usual value. Only the cached figures are used, so this
+# never touches the geometry.
+@api.route("/whatif")
+def what_if():
+    parameters = {}
+    for field in fields(DensificationFormula):
+        value = request.args.get(field.name)
+        if value is None:
+            continue
+        try:
+            parameters[field.name] = float(value)
+        except ValueError:
+            abort(400, f"{field.name} must be a number")
+        if not math.isfinite(parameters[field.name]):
+            abort(400, f"{field.name} must be a finite number")
+    unknown = set(request.args) - {field.name for field in fields(DensificationFormula)}
+    if unknown:
+        abort(400, f"Unknown parameters: {', '.join(sorted(unknown))}")
+
+    index = current_index()
+    body = _what_if_body(index.fingerprint, DensificationFormula(**parameters))
+    response = make_response(body)
+    response.content_type = "application/json"
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    return response.make_conditional(request)
+
+
+# The total matches the one printed by get_msoa_data, both leaving out MSOAs
+# whose new homes come out as nan
+@api.route("/summary")
+def summary():
+    return _json_response("summary")
+
+
+# Load the index when the app starts rather than on the first request, if the
+# cache is there yet. If not, it's loaded on the first request after it's built.
+def _load_index_if_built(state):
+    if os.path.exists(DENSITY_CACHE_PATH):
+        try:
+            current_index()
+        except HTTPException:
+            # Out of date, so requests get a 503 until it's rebuilt
+            pass
+
+
+api.record_once(_load_index_if_built)
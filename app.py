@@ -1,67 +1,306 @@
-from typing import List
-from flask import Flask, render_template
+import threading
+from typing import List, Optional
+from flask import Flask, abort, make_response, render_template, request
+from branca.colormap import LinearColormap
+from branca.element import MacroElement
 import folium
 from folium.features import GeoJson, GeoJsonPopup
 from dataclasses import asdict
+from jinja2 import Template
+import shapely
+import shapely.geometry
 
-from density import MsoaDensityData, get_msoa_data_cached, get_msoa_data
+from api import api
+from density import (
+    DENSITY_CACHE_PATH,
+    MsoaDensityData,
+    get_msoa_data_cached,
+    get_msoa_data,
+)
+from map_artifact import (
+    MapArtifact,
+    load_map_artifact,
+    source_fingerprint,
+    write_map_artifact,
+)
+from zoomstack.crs import bng_to_wgs84
+from zoomstack.parse_zoomstack_data import cached_usable_shape
+from vector_tiles import TILE_VERSION, TileSource, is_valid_tile
 
 app = Flask(__name__)
+app.register_blueprint(api)
+
+
+POPUP_FIELDS = [
+    "msoa_code",
+    "msoa_name",
+    "population",
+    # "urban_area",
+    # "building_coverage_area",
+    "area",
+    "building_coverage",
+    "dwellings",
+    "detached_or_semi_percent",
+    "population_density",
+    "occupation",
+    "dwelling_density",
+    "target_density",
+    "new_homes",
+]
+POPUP_ALIASES = [
+    "MSOA Code",
+    "Area name",
+    "Population",
+    # "Urban Area",
+    # "Building Coverage Area",
+    "Built Up Area",
+    "Building Coverage (%)",
+    "Number of Dwellings",
+    "Of which Detached or Semi-Detached (%)",
+    "Population Density",
+    "Occupation",
+    "Dwelling Density",
+    "Possible Density",
+    "New Homes Produced",
+]
+
+# What the map can be coloured by: (numeric feature property, legend caption)
+CHOROPLETH_PROPERTIES = {
+    "new_homes": ("new_homes_count", "New homes produced"),
+    "target_density": ("target_density_per_hectare", "Possible dwellings / hectare"),
+}
+CHOROPLETH_COLOURS = ["#ffffcc", "#fd8d3c", "#800026"]
+CHOROPLETH_STEPS = 6
+
+# Bump this when the page or the map on it is rendered differently, so pages
+# already built in ./build aren't served any more
+RENDER_VERSION = 1
+
+# Where the map starts when there are no MSOAs to fit it to (Brighton)
+DEFAULT_MAP_CENTRE = [50.8225, -0.1372]
+DEFAULT_MAP_ZOOM = 12
+
+
+# Styles every feature in the browser from one small function, rather than
+# sending a style for each MSOA
+class ChoroplethStyle(MacroElement):
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        {{ this._parent.get_name() }}.options.style = function(feature) {
+            var value = feature.properties[{{ this.property|tojson }}];
+            var thresholds = {{ this.thresholds|tojson }};
+            var colours = {{ this.colours|tojson }};
+            var colour = colours[0];
+            for (var i = 0; i < thresholds.length; i++) {
+                if (value >= thresholds[i]) {
+                    colour = colours[i];
+                }
+            }
+            return {fillColor: colour, color: colour, weight: 1, fillOpacity: 0.6};
+        };
+        {{ this._parent.get_name() }}.setStyle({{ this._parent.get_name() }}.options.style);
+        {% endmacro %}
+        """)
+
+    def __init__(self, property: str, thresholds: List[float], colours: List[str]):
+        super().__init__()
+        self._name = "ChoroplethStyle"
+        self.property = property
+        self.thresholds = thresholds
+        self.colours = colours
+
+
+def merged_feature_collection(msoa_data_list: List[MsoaDensityData]) -> dict:
+    features = []
+    for msoa_data in msoa_data_list:
+        features.extend(msoa_data.to_geojson_feature()["features"])
+    return {"type": "FeatureCollection", "features": features}
+
+
+# [[south, west], [north, east]] around every feature, or None if there are none
+def feature_collection_bounds(geojson_data: dict) -> Optional[list]:
+    geometries = [
+        shapely.geometry.shape(feature["geometry"])
+        for feature in geojson_data["features"]
+        if feature["geometry"]
+    ]
+    if not geometries:
+        return None
+    west, south, east, north = shapely.total_bounds(geometries).tolist()
+    return [[south, west], [north, east]]
+
+
+# geojson_data is merged_feature_collection(msoa_data_list), for callers that
+# already have it
+def render_map_html(
+    msoa_data_list: List[MsoaDensityData],
+    colour_by: str = "new_homes",
+    geojson_data: Optional[dict] = None,
+) -> str:
+    # One layer for all the MSOAs, with a single popup and tooltip definition
+    if geojson_data is None:
+        geojson_data = merged_feature_collection(msoa_data_list)
+
+    # Start over whichever MSOAs were built, rather than always over Brighton
+    bounds = feature_collection_bounds(geojson_data)
+    if bounds is None:
+        map = folium.Map(location=DEFAULT_MAP_CENTRE, zoom_start=DEFAULT_MAP_ZOOM)
+    else:
+        (south, west), (north, east) = bounds
+        map = folium.Map(
+            location=[(south + north) / 2, (west + east) / 2],
+            zoom_start=DEFAULT_MAP_ZOOM,
+        )
+        map.fit_bounds(bounds)
+    geojson = folium.GeoJson(
+        geojson_data,
+        name="MSOA Data",
+        popup=folium.GeoJsonPopup(fields=POPUP_FIELDS, aliases=POPUP_ALIASES),
+        tooltip=folium.GeoJsonTooltip(
+            fields=["msoa_name", "new_homes"], aliases=["Area name", "New homes"]
+        ),
+    )
+
+    property, caption = CHOROPLETH_PROPERTIES[colour_by]
+    values = [
+        feature["properties"][property] for feature in geojson_data["features"]
+    ] or [0]
+    colormap = LinearColormap(
+        CHOROPLETH_COLOURS, vmin=min(values), vmax=max(values), caption=caption
+    )
+    step = (colormap.vmax - colormap.vmin) / CHOROPLETH_STEPS
+    thresholds = [colormap.vmin + i * step for i in range(CHOROPLETH_STEPS)]
+    ChoroplethStyle(
+        property, thresholds, [colormap.rgb_hex_str(t) for t in thresholds]
+    ).add_to(geojson)
+    geojson.add_to(map)
+    colormap.to_step(CHOROPLETH_STEPS).add_to(map)
+
+    return map._repr_html_()
+
+
+# Render the whole page once, and save it alongside its GeoJSON
+def build_map_artifact(fingerprint: str) -> MapArtifact:
+    msoa_data_list: List[MsoaDensityData] = get_msoa_data_cached(with_geometry=True)
+    geojson = merged_feature_collection(msoa_data_list)
+    map_html = render_map_html(msoa_data_list, geojson_data=geojson)
+    with app.app_context():
+        page_html = render_template("index.html", map_html=map_html)
+
+    return write_map_artifact(page_html, geojson, fingerprint)
+
+
+_map_artifact: Optional[MapArtifact] = None
+_map_artifact_lock = threading.Lock()
+
+
+# Only rebuilds the page when the data cache has changed since it was last built
+def current_map_artifact() -> MapArtifact:
+    global _map_artifact
+    fingerprint = source_fingerprint(DENSITY_CACHE_PATH, f"page-{RENDER_VERSION}")
+    with _map_artifact_lock:
+        if _map_artifact is None or _map_artifact.source_fingerprint != fingerprint:
+            _map_artifact = load_map_artifact(fingerprint) or build_map_artifact(
+                fingerprint
+            )
+        return _map_artifact
+
+
+# A pre-built, pre-compressed body, in whichever of the encodings the browser
+# takes, or a 304 if it already has it
+def prebuilt_response(body, etag, content_type: str, encodings: List[str]):
+    encoding = request.accept_encodings.best_match(encodings, default="identity")
+
+    if request.if_none_match.contains(etag(encoding)):
+        response = make_response("", 304)
+    else:
+        response = make_response(body(encoding))
+        response.content_type = content_type
+        if encoding != "identity":
+            response.content_encoding = encoding
+    response.set_etag(etag(encoding))
+    response.vary.add("Accept-Encoding")
+    # Let browsers keep a copy, but check back with the ETag each time
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route("/")
 def index():
-    # Get your MsoaDensityData objects
-    msoa_data_list: List[MsoaDensityData] = (
-        get_msoa_data_cached()
-    )  # Assuming you have a function that returns a list of MsoaDensityData objects
+    artifact = current_map_artifact()
+
+    encodings = ["gzip", "identity"]
+    if artifact.brotli is not None:
+        encodings.insert(0, "br")
+    return prebuilt_response(
+        artifact.body, artifact.etag, "text/html; charset=utf-8", encodings
+    )
 
-    map = folium.Map(location=[50.8225, -0.1372], zoom_start=12)
 
+# The GeoJSON of every MSOA on the map, saved alongside the page
+@app.route("/msoas.geojson")
+def msoas_geojson():
+    artifact = current_map_artifact()
+    return prebuilt_response(
+        artifact.geojson_body,
+        artifact.geojson_etag,
+        "application/geo+json",
+        ["gzip", "identity"],
+    )
+
+
+def tile_source_for(
+    msoa_data_list: List[MsoaDensityData], cache_key: str
+) -> TileSource:
+    features = []
     for msoa_data in msoa_data_list:
-        geojson_data = msoa_data.to_geojson_feature()
-        geojson = folium.GeoJson(
-            geojson_data,
-            name="MSOA Data",
-            popup=folium.GeoJsonPopup(
-                fields=[
-                    "msoa_code",
-                    "msoa_name",
-                    "population",
-                    # "urban_area",
-                    # "building_coverage_area",
-                    "area",
-                    "building_coverage",
-                    "dwellings",
-                    "detached_or_semi_percent",
-                    "population_density",
-                    "occupation",
-                    "dwelling_density",
-                    "target_density",
-                    "new_homes",
-                ],
-                aliases=[
-                    "MSOA Code",
-                    "Area name",
-                    "Population",
-                    # "Urban Area",
-                    # "Building Coverage Area",
-                    "Built Up Area",
-                    "Building Coverage (%)",
-                    "Number of Dwellings",
-                    "Of which Detached or Semi-Detached (%)",
-                    "Population Density",
-                    "Occupation",
-                    "Dwelling Density",
-                    "Possible Density",
-                    "New Homes Produced",
-                ],
-            ),
-        )
-        geojson.add_to(map)
+        properties = {
+            "msoa_code": msoa_data.msoa_code,
+            "msoa_name": msoa_data.msoa_name,
+            "new_homes": msoa_data.new_homes(),
+            "target_density": msoa_data.target_density(),
+        }
+        # The full resolution usable shape where it's cached, rather than the
+        # simplified and rounded copy made for the page
+        shape = cached_usable_shape(msoa_data.msoa_code)
+        if shape is not None:
+            features.append((bng_to_wgs84(shape), properties))
+            continue
+        for feature in msoa_data.geojson["features"]:
+            geometry = shapely.geometry.shape(feature["geometry"])
+            features.append((geometry, properties))
+    return TileSource(features, cache_key)
+
+
+_tile_source: Optional[TileSource] = None
+_tile_source_lock = threading.Lock()
+
+
+def current_tile_source() -> TileSource:
+    global _tile_source
+    fingerprint = source_fingerprint(DENSITY_CACHE_PATH, f"tiles-{TILE_VERSION}")
+    with _tile_source_lock:
+        if _tile_source is None or _tile_source.cache_key != fingerprint:
+            _tile_source = tile_source_for(
+                get_msoa_data_cached(with_geometry=True), fingerprint
+            )
+        return _tile_source
+
+
+# Mapbox Vector Tiles of the usable area of each MSOA, so a map only has to
+# load the areas that are in view. The page itself doesn't use them (folium draws
+# the GeoJSON); they're for other map clients.
+@app.route("/tiles/<int:z>/<int:x>/<int:y>.pbf")
+def tile(z, x, y):
+    if not is_valid_tile(z, x, y):
+        abort(404)
 
-    map_html = map._repr_html_()
-    return render_template("index.html", map_html=map_html)
+    source = current_tile_source()
+    response = make_response(source.tile(z, x, y))
+    response.content_type = "application/vnd.mapbox-vector-tile"
+    response.set_etag(f"{source.cache_key}-{z}-{x}-{y}")
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 if __name__ == "__main__":
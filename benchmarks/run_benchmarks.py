@@ -0,0 +1,254 @@
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import time
+from dataclasses import asdict
+from typing import Callable, Dict, List, Optional
+
+from benchmarks.synthetic import Fixture, FixtureSize, make_fixture
+from census.census_table import (
+    DWELLINGS_FILE,
+    POPULATION_FILE,
+    load_census_table,
+)
+from census.collate_dwelling_types import read_msoa_dwellings
+from census.population import read_msoa_populations
+import zoomstack.parse_zoomstack_data as pz
+
+RESULTS_PATH = "./benchmarks/results.jsonl"
+# A benchmark counts as a regression when it's this much slower than the last
+# run on the same machine and fixture
+REGRESSION_RATIO = 1.2
+# Shortest time to measure in one go, see time_function
+MIN_SAMPLE_SECONDS = 0.1
+
+
+# Points the pipeline at the fixture's files instead of the real ones
+def use_fixture(fixture: Fixture):
+    pz.use_geopackage(fixture.geopackage_path)
+    pz.BOUNDARY_STORE_PATH = fixture.boundary_store_path
+    pz.boundary_store.cache_clear()
+    pz.USABLE_SHAPE_CACHE_FOLDER = fixture.shape_cache_folder
+    shutil.rmtree(fixture.shape_cache_folder, ignore_errors=True)
+
+
+def msoa_density_data(fixture: Fixture, shapes: dict) -> list:
+    from density import MsoaDensityData
+
+    census = load_census_table(fixture.census_folder)
+    return [
+        MsoaDensityData(
+            msoa_code=code,
+            msoa_name=census.name(code),
+            geojson=pz.geojson_for_shape(shapes[code], precision=pz.GEOJSON_PRECISION),
+            dwelling_info=census.dwellings(code),
+            urban_area=shapes[code].area,
+            building_coverage_area=shapes[code].area * 0.2,
+            population=census.msoa_population(code).total_population,
+        )
+        for code in fixture.msoa_codes
+    ]
+
+
+# Each benchmark takes the fixture, does any setup that shouldn't be timed, and
+# returns the function to time
+def benchmarks() -> Dict[str, Callable[[Fixture], Callable[[], object]]]:
+    def buildings_for_msoa(fixture):
+        boxes = {code: pz.get_msoa_bounding_box(code) for code in fixture.msoa_codes}
+        rings = {
+            code: pz.fetch_brighton_shape_cached(code) for code in fixture.msoa_codes
+        }
+        return lambda: [
+            pz.buildings_for_msoa(rings[code], boxes[code])
+            for code in fixture.msoa_codes
+        ]
+
+    def building_areas_for_msoas(fixture):
+        return lambda: pz.building_areas_for_msoas(fixture.msoa_codes)
+
+    def usable_shape_for_msoa(fixture):
+        boxes = {code: pz.get_msoa_bounding_box(code) for code in fixture.msoa_codes}
+        return lambda: [
+            pz.usable_shape_for_msoa(code, boxes[code]) for code in fixture.msoa_codes
+        ]
+
+    def geometries_to_geojson(fixture):
+        boxes = {code: pz.get_msoa_bounding_box(code) for code in fixture.msoa_codes}
+        shapes = [
+            pz.usable_shape_for_msoa(code, boxes[code]) for code in fixture.msoa_codes
+        ]
+        return lambda: pz.geometries_to_geojson(
+            shapes, tolerance=pz.SIMPLIFY_TOLERANCES[pz.GEOJSON_LEVEL], precision=6
+        )
+
+    def load_census(fixture):
+        return lambda: load_census_table(fixture.census_folder)
+
+    def read_dwellings(fixture):
+        return lambda: read_msoa_dwellings(fixture.census_folder + "/" + DWELLINGS_FILE)
+
+    def read_populations(fixture):
+        return lambda: read_msoa_populations(
+            fixture.census_folder + "/" + POPULATION_FILE
+        )
+
+    # What the index page does when there's no built map to serve
+    def render_map_html(fixture):
+        from app import render_map_html
+
+        boxes = {code: pz.get_msoa_bounding_box(code) for code in fixture.msoa_codes}
+        shapes = {
+            code: pz.usable_shape_for_msoa(code, boxes[code])
+            for code in fixture.msoa_codes
+        }
+        data = msoa_density_data(fixture, shapes)
+        return lambda: render_map_html(data)
+
+    return {
+        "buildings_for_msoa": buildings_for_msoa,
+        "building_areas_for_msoas": building_areas_for_msoas,
+        "usable_shape_for_msoa": usable_shape_for_msoa,
+        "geometries_to_geojson": geometries_to_geojson,
+        "load_census_table": load_census,
+        "read_msoa_dwellings": read_dwellings,
+        "read_msoa_populations": read_populations,
+        "app.index render_map_html": render_map_html,
+    }
+
+
+# Times are per call. Fast functions are called several times per sample, like
+# timeit does, so timer resolution and noise don't swamp them.
+def time_function(function: Callable[[], object], repeat: int) -> dict:
+    # Warm up: open files, fill the OS page cache, import modules
+    start = time.perf_counter()
+    function()
+    number = max(1, math.ceil(MIN_SAMPLE_SECONDS / (time.perf_counter() - start)))
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def git_revision() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(
+                ["git", *args], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "-s"))}
+
+
+def machine() -> dict:
+    return {
+        "node": platform.node(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+    }
+
+
+def read_results(path: str) -> List[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+# The last run before this one on the same machine and fixture
+def previous_run(results: List[dict], run: dict) -> Optional[dict]:
+    for previous in reversed(results):
+        if previous["machine"] == run["machine"] and previous["size"] == run["size"]:
+            return previous
+    return None
+
+
+def compare(run: dict, previous: Optional[dict]) -> List[str]:
+    regressions = []
+    for name, result in run["results"].items():
+        line = f"{name:32} {result['min'] * 1000:10.3f} ms"
+        if previous and name in previous["results"]:
+            # The fastest time is the one least affected by whatever else the
+            # machine was doing
+            ratio = result["min"] / previous["results"][name]["min"]
+            line += f"  {ratio:5.2f}x previous"
+            if ratio > REGRESSION_RATIO:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Time the pipeline on a synthetic Zoomstack GeoPackage"
+    )
+    parser.add_argument("--msoas", type=int, default=FixtureSize.msoas)
+    parser.add_argument("--buildings", type=int, default=FixtureSize.buildings)
+    parser.add_argument("--greenspace", type=int, default=FixtureSize.greenspace)
+    parser.add_argument("--seed", type=int, default=FixtureSize.seed)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--only", nargs="*", help="Names of the benchmarks to run (default: all)"
+    )
+    parser.add_argument("--results", default=RESULTS_PATH)
+    parser.add_argument(
+        "--no-record", action="store_true", help="Don't add this run to the results"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Exit with an error if anything has regressed since the last run",
+    )
+    options = parser.parse_args(args)
+
+    size = FixtureSize(
+        options.msoas, options.buildings, options.greenspace, options.seed
+    )
+    fixture = make_fixture(size)
+    use_fixture(fixture)
+
+    run = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        **git_revision(),
+        "machine": machine(),
+        "size": asdict(size),
+        "results": {},
+    }
+    for name, setup in benchmarks().items():
+        if options.only and name not in options.only:
+            continue
+        run["results"][name] = time_function(setup(fixture), options.repeat)
+
+    results = read_results(options.results)
+    regressions = compare(run, previous_run(results, run))
+
+    if not options.no_record:
+        with open(options.results, "a") as file:
+            file.write(json.dumps(run) + "\n")
+
+    if options.check and regressions:
+        raise SystemExit(f"Slower than the last run: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import csv
+import json
+import math
+import os
+from dataclasses import asdict, dataclass
+
+import fiona
+import numpy as np
+import shapely
+import shapely.affinity
+import shapely.geometry
+
+from zoomstack.boundary_store import BoundaryStore
+from zoomstack.crs import bng_to_wgs84
+
+FIXTURE_FOLDER = "./benchmarks/fixtures"
+
+# Where the synthetic MSOAs start, in BNG, roughly Brighton
+ORIGIN = (525000, 100000)
+MSOA_SIZE = 1500  # metres across
+# Distance between boundary vertices, so boundaries have as many vertices as
+# real ones (a few hundred)
+BOUNDARY_SEGMENT_LENGTH = 20
+# Most greenspace goes in the greenspace layer, the rest is woodland apart from
+# a few large national parks
+WOODLAND_FRACTION = 0.25
+NATIONAL_PARKS = 2
+
+DWELLING_TYPES = [
+    "Unshared dwelling: Detached whole house or bungalow",
+    "Unshared dwelling: Semi-detached house or bungalow",
+    "Unshared dwelling: Terraced (including end-terrace) house or bungalow",
+    "Unshared dwelling: Flat, maisonette or apartment: Purpose-built block of flats",
+    "Unshared dwelling: Flat, maisonette or apartment: Part of a converted or shared house",
+    "Unshared dwelling: Flat, maisonette or apartment: Part of another converted building",
+    "Unshared dwelling: Flat, maisonette or apartment: In a commercial building",
+    "Unshared dwelling: A caravan or other mobile or temporary structure",
+]
+
+
+# A synthetic stand-in for the Zoomstack GeoPackage, boundary store and census
+# files, so the pipeline can be timed without the national data. The same sizes
+# and seed always give the same files.
+@dataclass(frozen=True)
+class FixtureSize:
+    msoas: int = 30
+    buildings: int = 20_000
+    greenspace: int = 400
+    seed: int = 0
+
+    def name(self) -> str:
+        return "msoas{msoas}_buildings{buildings}_greenspace{greenspace}_seed{seed}".format(
+            **asdict(self)
+        )
+
+
+@dataclass
+class Fixture:
+    size: FixtureSize
+    folder: str
+    msoa_codes: list
+
+    @property
+    def geopackage_path(self) -> str:
+        return self.folder + "/zoomstack.gpkg"
+
+    @property
+    def boundary_store_path(self) -> str:
+        return self.folder + "/msoa_boundaries.sqlite"
+
+    @property
+    def census_folder(self) -> str:
+        return self.folder + "/census"
+
+    @property
+    def shape_cache_folder(self) -> str:
+        return self.folder + "/usable_shapes"
+
+
+def msoa_code(i: int) -> str:
+    # E029 isn't used by real MSOAs
+    return "E029{:05d}".format(i)
+
+
+def msoa_boundaries(size: FixtureSize) -> np.ndarray:
+    # A grid of squares, with vertices along the sides so they look like real
+    # boundaries to the geometry code. Neighbours share edges exactly.
+    columns = math.ceil(math.sqrt(size.msoas))
+    i = np.arange(size.msoas)
+    min_x = ORIGIN[0] + (i % columns) * MSOA_SIZE
+    min_y = ORIGIN[1] + (i // columns) * MSOA_SIZE
+    squares = shapely.box(min_x, min_y, min_x + MSOA_SIZE, min_y + MSOA_SIZE)
+    return shapely.segmentize(squares, BOUNDARY_SEGMENT_LENGTH)
+
+
+def random_boxes(rng, count: int, bounds, min_size: float, max_size: float):
+    min_x, min_y, max_x, max_y = bounds
+    x = rng.uniform(min_x, max_x, count)
+    y = rng.uniform(min_y, max_y, count)
+    width = rng.uniform(min_size, max_size, count)
+    height = rng.uniform(min_size, max_size, count)
+    return shapely.box(x, y, x + width, y + height)
+
+
+def greenspace_polygons(rng, count: int, bounds, min_size, max_size):
+    boxes = random_boxes(rng, count, bounds, min_size, max_size)
+    polygons = []
+    for i, box in enumerate(boxes):
+        # Every third one has a hole in it, like a lake in a park
+        if i % 3 == 0:
+            hole = shapely.affinity.scale(box, 0.3, 0.3)
+            polygons.append(shapely.Polygon(box.exterior, [hole.exterior]))
+        else:
+            # Greenspace has far more vertices than buildings do
+            polygons.append(shapely.segmentize(box, BOUNDARY_SEGMENT_LENGTH))
+    return polygons
+
+
+def write_layer(path: str, layer_name: str, geometries, properties: dict):
+    schema = {
+        "geometry": "Polygon",
+        "properties": {name: "str" for name in properties},
+    }
+    with fiona.open(
+        path, "w", driver="GPKG", layer=layer_name, crs="EPSG:27700", schema=schema
+    ) as output:
+        output.writerecords(
+            {
+                "type": "Feature",
+                "geometry": shapely.geometry.mapping(geometry),
+                "properties": {name: values[i] for name, values in properties.items()},
+            }
+            for i, geometry in enumerate(geometries)
+        )
+
+
+def write_census(folder: str, rng, msoa_codes):
+    os.makedirs(folder, exist_ok=True)
+    with open(folder + "/brighton_dwelling_types_counts.csv", "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(
+            [
+                "Middle layer Super Output Areas Code",
+                "Middle layer Super Output Areas",
+                "Accommodation by type of dwelling (9 categories) Code",
+                "Accommodation by type of dwelling (9 categories)",
+                "Observation",
+            ]
+        )
+        for i, code in enumerate(msoa_codes):
+            for type_code, label in enumerate(DWELLING_TYPES, start=1):
+                count = int(rng.integers(0, 2000))
+                writer.writerow([code, f"Synthetic {i:03d}", type_code, label, count])
+
+    with open(folder + "/brighton_population.csv", "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(
+            [
+                "Middle layer Super Output Areas Code",
+                "Middle layer Super Output Areas",
+                "Sex (2 categories) Code",
+                "Sex (2 categories)",
+                "Observation",
+            ]
+        )
+        for i, code in enumerate(msoa_codes):
+            for sex_code, sex in [(1, "Female"), (2, "Male")]:
+                count = int(rng.integers(2000, 6000))
+                writer.writerow([code, f"Synthetic {i:03d}", sex_code, sex, count])
+
+    # The real file starts with a byte order mark, so this one does too
+    with open(
+        folder + "/msoa_names.csv", "w", newline="", encoding="utf-8-sig"
+    ) as file:
+        writer = csv.writer(file)
+        writer.writerow(
+            [
+                "msoa21cd",
+                "msoa21nm",
+                "msoa21nmw",
+                "msoa21hclnm",
+                "msoa21hclnmw",
+                "localauthorityname",
+                "type",
+            ]
+        )
+        for i, code in enumerate(msoa_codes):
+            name = f"Synthetic {i:03d}"
+            writer.writerow(
+                [code, name, name, f"Place {i}", "", "Synthetic", "Present in 2011"]
+            )
+
+
+def make_fixture(size: FixtureSize, folder: str = FIXTURE_FOLDER) -> Fixture:
+    folder = folder + "/" + size.name()
+    codes = [msoa_code(i) for i in range(size.msoas)]
+    fixture = Fixture(size, folder, codes)
+    done_path = folder + "/fixture.json"
+    if os.path.exists(done_path):
+        return fixture
+
+    os.makedirs(folder, exist_ok=True)
+    for path in [fixture.geopackage_path, fixture.boundary_store_path]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    rng = np.random.default_rng(size.seed)
+    boundaries = msoa_boundaries(size)
+    bounds = shapely.total_bounds(boundaries)
+
+    buildings = random_boxes(rng, size.buildings, bounds, 5, 20)
+    write_layer(
+        fixture.geopackage_path,
+        "local_buildings",
+        buildings,
+        {"uuid": [str(i) for i in range(size.buildings)]},
+    )
+
+    woodland_count = int(size.greenspace * WOODLAND_FRACTION)
+    layers = {
+        "greenspace": greenspace_polygons(
+            rng, size.greenspace - woodland_count, bounds, 50, 400
+        ),
+        "woodland": greenspace_polygons(rng, woodland_count, bounds, 50, 400),
+        "national_parks": greenspace_polygons(rng, NATIONAL_PARKS, bounds, 2000, 3000),
+    }
+    for layer_name, polygons in layers.items():
+        write_layer(
+            fixture.geopackage_path,
+            layer_name,
+            polygons,
+            {"name": [str(i) for i in range(len(polygons))]},
+        )
+
+    store = BoundaryStore(fixture.boundary_store_path)
+    wgs84 = bng_to_wgs84(boundaries)
+    store.add(
+        {code: shapely.get_coordinates(g) for code, g in zip(codes, wgs84)},
+        {code: shapely.get_coordinates(g) for code, g in zip(codes, boundaries)},
+    )
+
+    write_census(fixture.census_folder, rng, codes)
+
+    # Written last, so a fixture that was only partly made is made again
+    with open(done_path, "w") as file:
+        json.dump(asdict(size), file)
+    return fixture
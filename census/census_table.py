@@ -0,0 +1,122 @@
+import csv
+import hashlib
+from array import array
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from census.collate_dwelling_types import MsoaDwellings, read_msoa_dwellings
+from census.population import MsoaPopulation, read_msoa_populations
+
+DATA_FOLDER = "./census"
+DWELLINGS_FILE = "brighton_dwelling_types_counts.csv"
+POPULATION_FILE = "brighton_population.csv"
+# This one covers every MSOA in England and Wales, not just Brighton
+NAMES_FILE = "msoa_names.csv"
+# Column of NAMES_FILE with the local authority each MSOA is in
+LOCAL_AUTHORITY_COLUMN = 5
+
+
+# All the census figures we need, one column per field and one row per MSOA.
+# Each csv file is read exactly once, so lookups don't rescan anything.
+@dataclass
+class CensusTable:
+    msoa_codes: List[str]
+    total_dwellings: array
+    detached_or_semi: array
+    population: array
+    names: List[Optional[str]]
+    index: Dict[str, int]
+
+    def __len__(self):
+        return len(self.msoa_codes)
+
+    def row(self, msoa_code: str) -> int:
+        return self.index[msoa_code]
+
+    def dwellings(self, msoa_code: str) -> MsoaDwellings:
+        i = self.index[msoa_code]
+        return MsoaDwellings(
+            msoa_code, self.total_dwellings[i], self.detached_or_semi[i]
+        )
+
+    def msoa_population(self, msoa_code: str) -> MsoaPopulation:
+        return MsoaPopulation(msoa_code, self.population[self.index[msoa_code]])
+
+    def name(self, msoa_code: str) -> str:
+        name = self.names[self.index[msoa_code]]
+        assert name is not None, f"MSOA code {msoa_code} not found in {NAMES_FILE}"
+        return name
+
+
+# Column 0 is the MSOA code, column 3 the House of Commons Library name
+def read_msoa_names(file_path) -> Dict[str, str]:
+    names = {}
+    # The file starts with a byte order mark
+    with open(file_path, "r", encoding="utf-8-sig") as file:
+        reader = csv.reader(file)
+        next(reader)  # Skip header row
+        for row in reader:
+            names[row[0]] = row[3]
+
+    return names
+
+
+# Column 0 is the MSOA code, column 5 the local authority name
+def read_msoa_local_authorities(file_path) -> Dict[str, str]:
+    local_authorities = {}
+    with open(file_path, "r", encoding="utf-8-sig") as file:
+        reader = csv.reader(file)
+        next(reader)  # Skip header row
+        for row in reader:
+            local_authorities[row[0]] = row[LOCAL_AUTHORITY_COLUMN]
+
+    return local_authorities
+
+
+# The dwellings and population files can be swapped for others with the same
+# columns, e.g. national ones, to cover more than Brighton
+def load_census_table(
+    data_folder: str = DATA_FOLDER,
+    dwellings_file: str = DWELLINGS_FILE,
+    population_file: str = POPULATION_FILE,
+) -> CensusTable:
+    dwellings = read_msoa_dwellings(data_folder + "/" + dwellings_file)
+    populations = read_msoa_populations(data_folder + "/" + population_file)
+    names = read_msoa_names(data_folder + "/" + NAMES_FILE)
+
+    # The dwellings file decides which MSOAs we look at, like get_all_msoas
+    msoa_codes = sorted(dwellings)
+    missing = MsoaPopulation(None, 0)
+    return CensusTable(
+        msoa_codes=msoa_codes,
+        total_dwellings=array("q", (dwellings[c].total_dwellings for c in msoa_codes)),
+        detached_or_semi=array(
+            "q", (dwellings[c].detached_or_semi for c in msoa_codes)
+        ),
+        population=array(
+            "q",
+            (populations.get(c, missing).total_population for c in msoa_codes),
+        ),
+        names=[names.get(c) for c in msoa_codes],
+        index={code: i for i, code in enumerate(msoa_codes)},
+    )
+
+
+# A hash of every census row for each MSOA, across all three files, so we can
+# tell which MSOAs' figures have changed since the last build
+def census_digests(
+    data_folder: str = DATA_FOLDER,
+    dwellings_file: str = DWELLINGS_FILE,
+    population_file: str = POPULATION_FILE,
+) -> Dict[str, str]:
+    digests = {}
+    for file_name in [dwellings_file, population_file, NAMES_FILE]:
+        with open(data_folder + "/" + file_name, "r", encoding="utf-8-sig") as file:
+            reader = csv.reader(file)
+            next(reader)  # Skip header row
+            for row in reader:
+                if row[0] not in digests:
+                    digests[row[0]] = hashlib.sha1()
+                digests[row[0]].update((file_name + ":" + ",".join(row)).encode())
+
+    return {msoa_code: digest.hexdigest() for msoa_code, digest in digests.items()}
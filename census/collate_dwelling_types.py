@@ -1,5 +1,6 @@
 import csv
 from dataclasses import dataclass
+from typing import Dict
 
 # csv format:
 # Middle layer Super Output Areas Code	Middle layer Super Output Areas	Accommodation by type of dwelling (9 categories) Code	Accommodation by type of dwelling (9 categories)	Observation
@@ -33,6 +34,24 @@ def get_msoa_dwellings(msoa_code, file_path):
     return MsoaDwellings(msoa_code, total_dwellings, detached_or_semi)
 
 
+# Single pass over the file, summing the dwellings for every MSOA at once
+def read_msoa_dwellings(file_path) -> Dict[str, MsoaDwellings]:
+    dwellings: Dict[str, MsoaDwellings] = {}
+    with open(file_path, "r") as file:
+        reader = csv.reader(file)
+        next(reader)  # Skip header row
+        for row in reader:
+            msoa_code = row[0]
+            if msoa_code not in dwellings:
+                dwellings[msoa_code] = MsoaDwellings(msoa_code, 0, 0)
+            observation = int(row[4])
+            dwellings[msoa_code].total_dwellings += observation
+            if int(row[2]) in DETACHED_OR_SEMI_LABELS:
+                dwellings[msoa_code].detached_or_semi += observation
+
+    return dwellings
+
+
 def get_all_msoas(file_path):
     msoas = set()
     with open(file_path, "r") as file:
@@ -47,8 +66,8 @@ def get_all_msoas(file_path):
 
 def brighton_msoa_dwellings():
     file_path = DATA_FOLDER + "/brighton_dwelling_types_counts.csv"
-    unique_msoas = get_all_msoas(file_path)
-    return [get_msoa_dwellings(msoa, file_path) for msoa in unique_msoas]
+    dwellings = read_msoa_dwellings(file_path)
+    return [dwellings[msoa] for msoa in sorted(dwellings)]
 
 
 if __name__ == "__main__":
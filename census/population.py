@@ -4,6 +4,7 @@
 
 import csv
 from dataclasses import dataclass
+from typing import Dict
 
 
 @dataclass
@@ -24,6 +25,21 @@ def get_msoa_population(msoa_code, file_path):
     return MsoaPopulation(msoa_code, total_population)
 
 
+# Single pass over the file, summing the population for every MSOA at once
+def read_msoa_populations(file_path) -> Dict[str, MsoaPopulation]:
+    populations: Dict[str, MsoaPopulation] = {}
+    with open(file_path, "r") as file:
+        reader = csv.reader(file)
+        next(reader)  # Skip header row
+        for row in reader:
+            msoa_code = row[0]
+            if msoa_code not in populations:
+                populations[msoa_code] = MsoaPopulation(msoa_code, 0)
+            populations[msoa_code].total_population += int(row[4])
+
+    return populations
+
+
 def get_all_msoas(file_path):
     msoas = set()
     with open(file_path, "r") as file:
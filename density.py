@@ -1,55 +1,117 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import cProfile
+import copy
 from dataclasses import asdict, dataclass
 import json
-import pickle
+import os
 import time
-from typing import List
-from census.population import get_msoa_population
+from typing import List, Optional
+
+import numpy as np
+
+from census.census_table import (
+    DWELLINGS_FILE,
+    NAMES_FILE,
+    POPULATION_FILE,
+    CensusTable,
+    census_digests,
+    load_census_table,
+)
 from zoomstack.parse_zoomstack_data import (
+    BUILDING_COVERAGE_VERSION,
+    GEOJSON_VERSION,
+    boundary_digest,
     building_area_for_msoa,
+    building_areas_for_msoas,
     geojson_for_msoa,
-    urban_area_for_msoa,
+    get_msoa_bounding_box,
+    open_zoomstack_reader,
+    prefetch_brighton_shapes,
+    usable_shape_for_msoa_cached,
     write_geojson_for_msoas,
+    zoomstack_digest_for_bounding_box,
+    zoomstack_fingerprint,
 )
-from census.collate_dwelling_types import (
-    MsoaDwellings,
-    brighton_msoa_dwellings,
-    get_all_msoas,
+from census.collate_dwelling_types import MsoaDwellings
+from density_formula import (
+    DEFAULT_FORMULA,
+    DensificationFormula,
+    SweepResults,
+    density_arrays,
+    sweep,
+    target_density,
+)
+import profiling
+from regions import (
+    SHARD_SIZE,
+    EmptySelectionError,
+    UnknownLocalAuthorityError,
+    msoas_in_bounding_box,
+    msoas_in_local_authorities,
+    spatial_shards,
+)
+from density_store import (
+    DensityStore,
+    StoreVersionError,
+    geometry_from_geojson,
+    write_density_store,
 )
 
 DATA_FOLDER = "./census"
+DENSITY_CACHE_PATH = DATA_FOLDER + "/brighton_density.arrow"
+# Hashes of the inputs each cached MSOA was built from, see get_msoa_data
+DENSITY_INPUTS_PATH = DATA_FOLDER + "/brighton_density_inputs.json"
+# The census files the build reads. main() can point these at others with the
+# same columns, e.g. national ones.
+CENSUS_FOLDER = DATA_FOLDER
+CENSUS_DWELLINGS_FILE = DWELLINGS_FILE
+CENSUS_POPULATION_FILE = POPULATION_FILE
+
+
+def load_census() -> CensusTable:
+    return load_census_table(
+        CENSUS_FOLDER, CENSUS_DWELLINGS_FILE, CENSUS_POPULATION_FILE
+    )
 
 
 @dataclass
 class MsoaDensityData:
     msoa_code: str
     msoa_name: str
-    geojson: str
+    # None when loaded from the cache without geometry
+    geojson: Optional[dict]
     dwelling_info: MsoaDwellings
     urban_area: float
     building_coverage_area: float
     population: int
 
-    def target_density(self) -> float:
-        existing_density = self.dwelling_info.total_dwellings / (
-            self.urban_area / 10_000
-        )
-        detached_or_semi_percent = (
-            self.dwelling_info.detached_or_semi / self.dwelling_info.total_dwellings
-        )
-        if detached_or_semi_percent > 0.4:
-            new_density = existing_density * 1.5
-        elif detached_or_semi_percent < 0.1:
-            new_density = existing_density * 1.1
-        else:
-            new_density = existing_density * 1.25
-
-        coverage_percent = self.building_coverage_area / self.urban_area
-        if coverage_percent < 0.2:
-            new_density *= 1.4
-
-        return new_density
-
-    def derived_properties(self) -> dict:
+    def columns(self) -> dict:
+        return {
+            "total_dwellings": self.dwelling_info.total_dwellings,
+            "detached_or_semi": self.dwelling_info.detached_or_semi,
+            "urban_area": self.urban_area,
+            "building_coverage_area": self.building_coverage_area,
+            "population": self.population,
+        }
+
+    # These all go through the same vectorised formula as the batch API, see
+    # density_formula.density_arrays, with Russell's numbers unless given others
+    def density_values(self, formula: DensificationFormula = DEFAULT_FORMULA) -> dict:
+        return {
+            name: float(value)
+            for name, value in density_arrays(self.columns(), formula).items()
+        }
+
+    def target_density(self, formula: DensificationFormula = DEFAULT_FORMULA) -> float:
+        return float(target_density(self.columns(), formula))
+
+    def new_homes(self, formula: DensificationFormula = DEFAULT_FORMULA) -> float:
+        return self.density_values(formula)["new_homes"]
+
+    def derived_properties(
+        self, formula: DensificationFormula = DEFAULT_FORMULA
+    ) -> dict:
         properties = {}
         ## Area: 60.13 ha
         ## Building Coverage: 29.09%
@@ -57,42 +119,44 @@ class MsoaDensityData:
         ## Population Density: 138 people / hectare
         ## Occupation: 1.85 people / dwelling
         ## Dwelling Density: 74 dwellings / hectare
-        area_in_hectares = self.urban_area / 10_000
-        properties["area"] = f"{area_in_hectares:.2f} ha"
+        values = self.density_values(formula)
+        properties["area"] = f"{values['area_in_hectares']:.2f} ha"
         properties["building_coverage"] = (
-            f"{self.building_coverage_area / self.urban_area * 100:.2f}%"
+            f"{values['building_coverage_fraction'] * 100:.2f}%"
         )
         properties["dwellings"] = self.dwelling_info.total_dwellings
         properties["detached_or_semi_percent"] = (
-            f"{self.dwelling_info.detached_or_semi / self.dwelling_info.total_dwellings * 100:.2f}%"
+            f"{values['detached_or_semi_fraction'] * 100:.2f}%"
         )
         properties["population_density"] = (
-            f"{self.population / area_in_hectares:.2f} people / hectare"
-        )
-        properties["occupation"] = (
-            f"{self.population / self.dwelling_info.total_dwellings:.2f} people / dwelling"
+            f"{values['population_density']:.2f} people / hectare"
         )
+        properties["occupation"] = f"{values['occupation']:.2f} people / dwelling"
         properties["dwelling_density"] = (
-            f"{self.dwelling_info.total_dwellings / area_in_hectares:.2f} dwellings / hectare"
+            f"{values['dwelling_density']:.2f} dwellings / hectare"
         )
-        target = self.target_density()
+        target = values["target_density"]
         properties["target_density"] = f"{target:.2f} dwellings / hectare"
-        new_homes = target * area_in_hectares - self.dwelling_info.total_dwellings
+        new_homes = values["new_homes"]
         properties["new_homes"] = f"{new_homes:.0f} new homes"
+        # Plain numbers as well, for the map to colour the areas by
+        properties["target_density_per_hectare"] = target
+        properties["new_homes_count"] = new_homes
         return properties
 
-    def to_geojson_feature(self):
+    def to_geojson_feature(self, formula: DensificationFormula = DEFAULT_FORMULA):
         properties = asdict(self)
 
         del properties["geojson"]  # Remove the geojson field
 
         # feature_collection = json.loads(self.geojson)
-        feature_collection = self.geojson
+        # Copy it, so adding the properties doesn't change the cached geojson
+        feature_collection = copy.deepcopy(self.geojson)
 
         for feature in feature_collection["features"]:
             feature["properties"].update(properties)
 
-        additional_properties = self.derived_properties()
+        additional_properties = self.derived_properties(formula)
         for feature in feature_collection["features"]:
             feature["properties"].update(additional_properties)
 
@@ -110,20 +174,27 @@ def get_msoa_name(msoa_code: str, file_path: str) -> str:
     assert False, f"MSOA code {msoa_code} not found in file {file_path}"
 
 
-def density_data_for_msoa(msoa_code: str):
-    all_msoa_dwellings = brighton_msoa_dwellings()
-    this_msoa_dwellings = [d for d in all_msoa_dwellings if d.msoa_code == msoa_code][0]
-
-    urban_area = urban_area_for_msoa(msoa_code)
-    building_coverage = building_area_for_msoa(msoa_code)
-    building_coverage = building_area_for_msoa(msoa_code)
-    population = get_msoa_population(
-        msoa_code, DATA_FOLDER + "/brighton_population.csv"
-    )
+def density_data_for_msoa(
+    msoa_code: str,
+    census: Optional[CensusTable] = None,
+    building_coverage: Optional[float] = None,
+):
+    # Pass the table in when doing many MSOAs, so the csv files are only read once
+    if census is None:
+        census = load_census()
+    # Likewise the building area, which is quicker to find for all MSOAs at once
+    if building_coverage is None:
+        building_coverage = building_area_for_msoa(msoa_code)
+    with profiling.stage("census"):
+        this_msoa_dwellings = census.dwellings(msoa_code)
+        population = census.msoa_population(msoa_code)
+        name = census.name(msoa_code)
+
+    # The area and the GeoJSON both come from the same cached usable shape,
+    # the GeoJSON from a simplified copy of it
+    urban_area = usable_shape_for_msoa_cached(msoa_code).area
     geojson = geojson_for_msoa(msoa_code)
 
-    name = get_msoa_name(msoa_code, DATA_FOLDER + "/msoa_names.csv")
-
     out = MsoaDensityData(
         msoa_code=msoa_code,
         msoa_name=name,
@@ -164,68 +235,392 @@ def print_density_data(density_data: MsoaDensityData):
     )
 
 
-def get_msoa_data_cached() -> List[MsoaDensityData]:
-    # get the data from this dumped file:
-    # with open(DATA_FOLDER + "/brighton_full_density_data.json", "w") as file:
-    #    json.dump([asdict(d) for d in out], file)
-
-    with open(DATA_FOLDER + "/brighton_full_density_data.json", "rb") as file:
-        data = pickle.load(file)
-        print("Loaded data from cache")
-        print(data[0])
-        return data
+# Startup only needs the scalar columns, so geometry is left as None unless asked
+# for. It can be read later, one MSOA at a time, with DensityStore.geojson.
+def get_msoa_data_cached(with_geometry: bool = False) -> List[MsoaDensityData]:
+    store = DensityStore(DENSITY_CACHE_PATH)
+    columns = store.scalars()
+    data = [
+        MsoaDensityData(
+            msoa_code=msoa_code,
+            msoa_name=columns["msoa_name"][i],
+            geojson=store.geojson(msoa_code) if with_geometry else None,
+            dwelling_info=MsoaDwellings(
+                msoa_code,
+                columns["total_dwellings"][i],
+                columns["detached_or_semi"][i],
+            ),
+            urban_area=columns["urban_area"][i],
+            building_coverage_area=columns["building_coverage_area"][i],
+            population=columns["population"][i],
+        )
+        for i, msoa_code in enumerate(columns["msoa_code"])
+    ]
+    print("Loaded data from cache")
+    return data
+
+
+# The scalar fields of many MSOAs as one list per column, the shape that both the
+# density store and density_formula.density_arrays take
+def msoa_data_columns(data: List[MsoaDensityData]) -> dict:
+    return {
+        "msoa_code": [d.msoa_code for d in data],
+        "msoa_name": [d.msoa_name for d in data],
+        "total_dwellings": [d.dwelling_info.total_dwellings for d in data],
+        "detached_or_semi": [d.dwelling_info.detached_or_semi for d in data],
+        "urban_area": [d.urban_area for d in data],
+        "building_coverage_area": [d.building_coverage_area for d in data],
+        "population": [d.population for d in data],
+    }
+
+
+# The inputs file only describes the cache it was written with, so it's removed
+# whenever the cache is rewritten. An incremental build writes it again after;
+# otherwise the next incremental build starts from scratch rather than trusting
+# out of date hashes.
+def write_msoa_data_cache(data: List[MsoaDensityData]):
+    columns = msoa_data_columns(data)
+    with profiling.stage("serialisation"):
+        columns["geometry"] = [geometry_from_geojson(d.geojson) for d in data]
+        write_density_store(DENSITY_CACHE_PATH, columns)
+    if os.path.exists(DENSITY_INPUTS_PATH):
+        os.remove(DENSITY_INPUTS_PATH)
+
+
+# Try out many versions of the formula. This only reads the scalar columns of
+# the cache, so it never touches the GeoPackage.
+def sweep_cached(
+    formulas: List[DensificationFormula], processes: Optional[int] = None
+) -> SweepResults:
+    return sweep(DensityStore(DENSITY_CACHE_PATH).scalars(), formulas, processes)
+
+
+# Census table for worker processes, see _init_worker
+_worker_census: Optional[CensusTable] = None
+
+
+def _init_worker(census: CensusTable, profile: bool = False):
+    global _worker_census
+    _worker_census = census
+    profiling.enable(profile)
+    open_zoomstack_reader()
+
+
+# Only for the shape cache it fills in. Sends back what was recorded, as below.
+def _usable_shape_in_worker(msoa_code: str):
+    with profiling.msoa(msoa_code):
+        usable_shape_for_msoa_cached(msoa_code)
+    return profiling.take() if profiling.is_enabled() else None
+
+
+# Sends back what was recorded while working on the MSOA too, for the main
+# process to add to its own
+def _density_data_in_worker(msoa_code: str, building_coverage: float):
+    with profiling.msoa(msoa_code):
+        data = density_data_for_msoa(msoa_code, _worker_census, building_coverage)
+    return data, profiling.take() if profiling.is_enabled() else None
+
+
+# A whole shard, with the building areas found for just its MSOAs, so the worker
+# only reads the buildings in the shard's part of the GeoPackage
+def _shard_in_worker(msoa_codes: List[str]):
+    data = build_msoa_data(msoa_codes, _worker_census)
+    return data, profiling.take() if profiling.is_enabled() else None
+
+
+# Builds each shard of shard_size neighbouring MSOAs on its own, over a process
+# pool when processes > 1, and gives the results back in the order of msoa_codes
+def build_sharded_msoa_data(
+    msoa_codes: List[str],
+    census: CensusTable,
+    processes: Optional[int] = None,
+    shard_size: int = SHARD_SIZE,
+) -> List[MsoaDensityData]:
+    shards = spatial_shards(msoa_codes, shard_size)
+    print("Shards: ", len(shards))
+    if processes is None or processes <= 1:
+        built = [build_msoa_data(shard, census) for shard in shards]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_init_worker,
+            initargs=(census, profiling.is_enabled()),
+        ) as executor:
+            built = []
+            for data, recorded in executor.map(_shard_in_worker, shards):
+                if recorded is not None:
+                    profiling.merge(recorded)
+                built.append(data)
+
+    by_code = {d.msoa_code: d for shard_data in built for d in shard_data}
+    return [by_code[msoa_code] for msoa_code in msoa_codes]
+
+
+# Each MSOA is independent of the others, so with processes > 1 they are shared
+# out over a process pool in chunks of chunksize MSOAs
+def build_msoa_data(
+    msoa_codes: List[str],
+    census: CensusTable,
+    processes: Optional[int] = None,
+    chunksize: int = 4,
+) -> List[MsoaDensityData]:
+    if not msoa_codes:
+        return []
+
+    if processes is None or processes <= 1:
+        # Work out the usable shapes first, each recorded against its MSOA, as
+        # building_areas_for_msoas needs them all at once
+        for msoa_id in msoa_codes:
+            with profiling.msoa(msoa_id):
+                usable_shape_for_msoa_cached(msoa_id)
+        building_areas = building_areas_for_msoas(msoa_codes)
+        out = []
+        for msoa_id in msoa_codes:
+            with profiling.msoa(msoa_id):
+                out.append(
+                    density_data_for_msoa(msoa_id, census, building_areas[msoa_id])
+                )
+        return out
+
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=_init_worker,
+        initargs=(census, profiling.is_enabled()),
+    ) as executor:
+        # Building areas are measured inside the usable shapes, so work those
+        # out first, in parallel, rather than one by one in this process
+        for recorded in executor.map(
+            _usable_shape_in_worker, msoa_codes, chunksize=chunksize
+        ):
+            if recorded is not None:
+                profiling.merge(recorded)
+        building_areas = building_areas_for_msoas(msoa_codes)
+        # map gives the results back in the order of the MSOA codes
+        results = list(
+            executor.map(
+                _density_data_in_worker,
+                msoa_codes,
+                [building_areas[msoa_id] for msoa_id in msoa_codes],
+                chunksize=chunksize,
+            )
+        )
+    out = []
+    for data, recorded in results:
+        if recorded is not None:
+            profiling.merge(recorded)
+        out.append(data)
+    return out
 
 
-def get_msoa_data() -> List[MsoaDensityData]:
-    start = time.time()
-    all_brighton_msoas = get_all_msoas(
-        DATA_FOLDER + "/brighton_dwelling_types_counts.csv"
+# Hashes of everything each MSOA's figures are calculated from. Scanning the
+# Zoomstack features is the slow part, so if the GeoPackage file itself hasn't
+# changed, the previous hashes are reused for MSOAs whose boundary is the same.
+def msoa_inputs(msoa_codes: List[str], previous: dict) -> dict:
+    census_hashes = census_digests(
+        CENSUS_FOLDER, CENSUS_DWELLINGS_FILE, CENSUS_POPULATION_FILE
     )
-
-    out = [density_data_for_msoa(msoa_id) for msoa_id in all_brighton_msoas]
+    zoomstack_file = zoomstack_fingerprint()
+    previous_msoas = {}
+    if previous.get("zoomstack_file") == zoomstack_file:
+        previous_msoas = previous["msoas"]
+
+    msoas = {}
+    for msoa_code in msoa_codes:
+        boundary = boundary_digest(msoa_code)
+        old = previous_msoas.get(msoa_code, {})
+        if old.get("boundary") == boundary:
+            zoomstack = old["zoomstack"]
+        else:
+            zoomstack = zoomstack_digest_for_bounding_box(
+                get_msoa_bounding_box(msoa_code)
+            )
+        msoas[msoa_code] = {
+            "boundary": boundary,
+            "census": census_hashes.get(msoa_code, ""),
+            "zoomstack": zoomstack,
+            "building_coverage": BUILDING_COVERAGE_VERSION,
+            "geojson": GEOJSON_VERSION,
+        }
+    return {"zoomstack_file": zoomstack_file, "msoas": msoas}
+
+
+def read_msoa_inputs() -> dict:
+    if not os.path.exists(DENSITY_INPUTS_PATH):
+        return {"msoas": {}}
+    with open(DENSITY_INPUTS_PATH, "r") as file:
+        return json.load(file)
+
+
+# With incremental=True, only the MSOAs whose inputs have changed since the last
+# incremental build are recalculated, and the rest are kept from the cache.
+#
+# By default every MSOA in the census files is built. local_authorities (names
+# as in the MSOA names file) and bounding_box (BNG) narrow that down, and the
+# cache then holds just those MSOAs. With shard_size, the MSOAs are built in
+# shards of that many neighbouring MSOAs, see build_sharded_msoa_data, which
+# scales better to large areas than sharing out single MSOAs.
+def get_msoa_data(
+    processes: Optional[int] = None,
+    chunksize: int = 4,
+    incremental: bool = False,
+    local_authorities: Optional[List[str]] = None,
+    bounding_box=None,
+    shard_size: Optional[int] = None,
+) -> List[MsoaDensityData]:
+    start = time.time()
+    census = load_census()
+    all_msoas = sorted(census.msoa_codes)
+    if local_authorities:
+        all_msoas = msoas_in_local_authorities(
+            all_msoas, local_authorities, CENSUS_FOLDER + "/" + NAMES_FILE
+        )
+    # Fetch any boundaries we don't have up front, in batches, rather than one
+    # request at a time from inside the build
+    missing = prefetch_brighton_shapes(all_msoas)
+    if missing:
+        # Nothing can be worked out for them, so leave them out of the build
+        print("No boundary found, so skipping: ", ", ".join(missing))
+        skipped = set(missing)
+        all_msoas = [msoa_id for msoa_id in all_msoas if msoa_id not in skipped]
+    if bounding_box is not None:
+        all_msoas = msoas_in_bounding_box(all_msoas, bounding_box)
+    # Rather than replace the cache with an empty one
+    if not all_msoas:
+        raise EmptySelectionError(
+            "No MSOAs to build: none in the census files match the local "
+            "authorities and bounding box given"
+        )
+    print("MSOAs selected: ", len(all_msoas))
+
+    to_build = all_msoas
+    previous = {}
+    if incremental:
+        previous_inputs = read_msoa_inputs()
+        inputs = msoa_inputs(all_msoas, previous_inputs)
+        try:
+            previous = {
+                d.msoa_code: d for d in get_msoa_data_cached(with_geometry=True)
+            }
+        except (FileNotFoundError, StoreVersionError):
+            previous = {}
+        to_build = [
+            msoa_id
+            for msoa_id in all_msoas
+            if msoa_id not in previous
+            or previous_inputs["msoas"].get(msoa_id) != inputs["msoas"][msoa_id]
+        ]
+        print("MSOAs with changed inputs: ", len(to_build))
+
+    if shard_size:
+        built = build_sharded_msoa_data(to_build, census, processes, shard_size)
+    else:
+        built = build_msoa_data(to_build, census, processes, chunksize)
+    built = {d.msoa_code: d for d in built}
+    out = [built.get(msoa_id) or previous[msoa_id] for msoa_id in all_msoas]
     end = time.time()
     print("Time taken to get all MSOAs: ", end - start)
 
-    # Dump the data to a json file
-    with open(DATA_FOLDER + "/brighton_full_density_data.json", "wb") as file:
-        pickle.dump(out, file)
+    write_msoa_data_cache(out)
+    if incremental:
+        with open(DENSITY_INPUTS_PATH, "w") as file:
+            json.dump(inputs, file, indent=2, sort_keys=True)
 
-    total_new_homes = sum(
-        [
-            d.target_density() * (d.urban_area / 10_000)
-            - d.dwelling_info.total_dwellings
-            for d in out
-        ]
-    )
+    # nansum, as MSOAs with no dwellings have no new homes figure
+    total_new_homes = np.nansum(density_arrays(msoa_data_columns(out))["new_homes"])
     print("Total new homes: ", total_new_homes)
     return out
 
 
-def main():
-    get_msoa_data()
-    # msoa_id = "E02003491"
-    all_brighton_msoas = get_all_msoas(
-        DATA_FOLDER + "/brighton_dwelling_types_counts.csv"
+def main(args: Optional[List[str]] = None):
+    global CENSUS_FOLDER, CENSUS_DWELLINGS_FILE, CENSUS_POPULATION_FILE
+    parser = argparse.ArgumentParser(description="Build the MSOA density cache")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=profiling.PROFILE_REPORT_PATH,
+        metavar="REPORT",
+        help="Write time per stage and counters for each MSOA to a JSON report "
+        f"(default {profiling.PROFILE_REPORT_PATH})",
     )
+    parser.add_argument(
+        "--cprofile",
+        metavar="FILE",
+        help="Also dump cProfile stats for the main process, for snakeviz etc. "
+        "Use --processes 1 to include the work done in workers.",
+    )
+    region = parser.add_argument_group(
+        "region", "Which MSOAs to build (default: every MSOA in the census files)"
+    )
+    region.add_argument(
+        "--local-authority",
+        action="append",
+        dest="local_authorities",
+        metavar="NAME",
+        help="Only MSOAs in this local authority, as named in the MSOA names "
+        "file. Can be given more than once.",
+    )
+    region.add_argument(
+        "--bbox",
+        type=float,
+        nargs=4,
+        metavar=("MIN_X", "MIN_Y", "MAX_X", "MAX_Y"),
+        help="Only MSOAs overlapping this box, in British National Grid metres",
+    )
+    region.add_argument(
+        "--shard-size",
+        type=int,
+        nargs="?",
+        const=SHARD_SIZE,
+        help="Build in shards of this many neighbouring MSOAs "
+        f"(default {SHARD_SIZE}), for large areas",
+    )
+    census_files = parser.add_argument_group(
+        "census", "Census files with the same columns as the Brighton ones"
+    )
+    census_files.add_argument("--census-folder", default=CENSUS_FOLDER)
+    census_files.add_argument("--dwellings-file", default=CENSUS_DWELLINGS_FILE)
+    census_files.add_argument("--population-file", default=CENSUS_POPULATION_FILE)
+    options = parser.parse_args(args)
+
+    CENSUS_FOLDER = options.census_folder
+    CENSUS_DWELLINGS_FILE = options.dwellings_file
+    CENSUS_POPULATION_FILE = options.population_file
+
+    if options.profile:
+        profiling.enable()
+    profiler = cProfile.Profile() if options.cprofile else None
+    if profiler:
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        data = get_msoa_data(
+            processes=options.processes,
+            incremental=options.incremental,
+            local_authorities=options.local_authorities,
+            bounding_box=options.bbox,
+            shard_size=options.shard_size,
+        )
+    except (UnknownLocalAuthorityError, EmptySelectionError) as error:
+        parser.error(str(error))
+    total_seconds = time.perf_counter() - start
 
-    # write_geojson_for_msoas(all_brighton_msoas)
-
-    # msoa_id = "E02003512"
-    for msoa_id in all_brighton_msoas:
-
-        start_time = time.time()
-        density_data = density_data_for_msoa(msoa_id)
-        end_time = time.time()
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(options.cprofile)
+    if options.profile:
+        profiling.write_report(options.profile, total_seconds)
+        print("Profile written to ", options.profile)
 
-        # print("********")
-        # print("MSOA ID: ", msoa_id)
-        # print("time taken: ", end_time - start_time)
-        # print("********")
+    # msoa_id = "E02003491"
+    # write_geojson_for_msoas([d.msoa_code for d in data])
 
+    # msoa_id = "E02003512"
+    for density_data in data:
         print_density_data(density_data)
 
 
 if __name__ == "__main__":
-    # import cProfile
-    # cProfile.run("main()", filename="density_2.prof")
     main()
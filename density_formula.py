@@ -0,0 +1,164 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, fields
+import itertools
+from typing import Dict, List, Mapping, Optional
+
+import numpy as np
+
+# The columns the formula needs, named as in the density store
+INPUT_COLUMNS = [
+    "total_dwellings",
+    "detached_or_semi",
+    "urban_area",
+    "building_coverage_area",
+    "population",
+]
+
+
+# The numbers in Russell's formula:
+#   IF familyHouses > 40% THEN newDensity = existingDensity x 1.5
+#   ELSE IF familyHouses < 10% THEN newDensity = existingDensity x 1.1
+#   ELSE newDensity = existingDensity x 1.25
+#   IF coverage < 20% THEN newDensity = newDensity x 1.4
+@dataclass(frozen=True)
+class DensificationFormula:
+    high_family_threshold: float = 0.4
+    high_family_uplift: float = 1.5
+    low_family_threshold: float = 0.1
+    low_family_uplift: float = 1.1
+    default_uplift: float = 1.25
+    coverage_threshold: float = 0.2
+    coverage_bonus: float = 1.4
+
+
+DEFAULT_FORMULA = DensificationFormula()
+
+
+def _as_arrays(columns: Mapping) -> Dict[str, np.ndarray]:
+    return {name: np.asarray(columns[name], dtype=float) for name in INPUT_COLUMNS}
+
+
+# parameters maps each DensificationFormula field to either a number, or a column
+# of numbers (one per scenario) that broadcasts against the MSOA arrays
+def _target_density(
+    existing_density, family_fraction, coverage_fraction, parameters: Mapping
+):
+    uplift = np.select(
+        [
+            family_fraction > parameters["high_family_threshold"],
+            family_fraction < parameters["low_family_threshold"],
+        ],
+        [parameters["high_family_uplift"], parameters["low_family_uplift"]],
+        default=parameters["default_uplift"],
+    )
+    target = existing_density * uplift
+    return np.where(
+        coverage_fraction < parameters["coverage_threshold"],
+        target * parameters["coverage_bonus"],
+        target,
+    )
+
+
+def target_density(
+    columns: Mapping, formula: DensificationFormula = DEFAULT_FORMULA
+) -> np.ndarray:
+    return density_arrays(columns, formula)["target_density"]
+
+
+# Target density, new homes and every ratio shown on the map, as one array each.
+# Areas with no dwellings or no urban area come out as nan or inf rather than
+# raising.
+def density_arrays(
+    columns: Mapping, formula: DensificationFormula = DEFAULT_FORMULA
+) -> Dict[str, np.ndarray]:
+    c = _as_arrays(columns)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        area_in_hectares = c["urban_area"] / 10_000
+        existing_density = c["total_dwellings"] / area_in_hectares
+        detached_or_semi_fraction = c["detached_or_semi"] / c["total_dwellings"]
+        building_coverage_fraction = c["building_coverage_area"] / c["urban_area"]
+        target = _target_density(
+            existing_density,
+            detached_or_semi_fraction,
+            building_coverage_fraction,
+            asdict(formula),
+        )
+
+        return {
+            "area_in_hectares": area_in_hectares,
+            "building_coverage_fraction": building_coverage_fraction,
+            "detached_or_semi_fraction": detached_or_semi_fraction,
+            "population_density": c["population"] / area_in_hectares,
+            "occupation": c["population"] / c["total_dwellings"],
+            "dwelling_density": existing_density,
+            "target_density": target,
+            "new_homes": target * area_in_hectares - c["total_dwellings"],
+        }
+
+
+# Every combination of the given values, with the defaults for anything not given,
+# e.g. formula_grid(coverage_bonus=[1.2, 1.4], high_family_uplift=[1.5, 2])
+def formula_grid(**values: List[float]) -> List[DensificationFormula]:
+    names = list(values)
+    return [
+        DensificationFormula(**dict(zip(names, combination)))
+        for combination in itertools.product(*(values[name] for name in names))
+    ]
+
+
+@dataclass
+class SweepResults:
+    formulas: List[DensificationFormula]
+    msoa_codes: List[str]
+    # One row per formula and one column per MSOA
+    new_homes: np.ndarray
+
+    def totals(self) -> np.ndarray:
+        return np.nansum(self.new_homes, axis=1)
+
+    def scenario(self, i: int) -> Dict[str, float]:
+        return dict(zip(self.msoa_codes, self.new_homes[i].tolist()))
+
+
+def new_homes_for_formulas(
+    columns: Mapping, formulas: List[DensificationFormula]
+) -> np.ndarray:
+    c = _as_arrays(columns)
+    # Each parameter as a column, so it broadcasts against a row of MSOAs
+    parameters = {
+        field.name: np.array([getattr(f, field.name) for f in formulas])[:, None]
+        for field in fields(DensificationFormula)
+    }
+    with np.errstate(divide="ignore", invalid="ignore"):
+        area_in_hectares = c["urban_area"] / 10_000
+        target = _target_density(
+            c["total_dwellings"] / area_in_hectares,
+            c["detached_or_semi"] / c["total_dwellings"],
+            c["building_coverage_area"] / c["urban_area"],
+            parameters,
+        )
+        return target * area_in_hectares - c["total_dwellings"]
+
+
+# Runs many versions of the formula over the same (cached) MSOA figures. The
+# formulas are done a chunk at a time to bound memory, optionally in parallel.
+def sweep(
+    columns: Mapping,
+    formulas: List[DensificationFormula],
+    processes: Optional[int] = None,
+    chunksize: int = 256,
+) -> SweepResults:
+    inputs = {name: np.asarray(columns[name]) for name in INPUT_COLUMNS}
+    chunks = [formulas[i : i + chunksize] for i in range(0, len(formulas), chunksize)]
+    if processes is None or processes <= 1:
+        results = [new_homes_for_formulas(inputs, chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(
+                executor.map(new_homes_for_formulas, itertools.repeat(inputs), chunks)
+            )
+
+    new_homes = (
+        np.vstack(results) if results else np.empty((0, len(columns["msoa_code"])))
+    )
+    return SweepResults(formulas, list(columns["msoa_code"]), new_homes)
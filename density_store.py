@@ -0,0 +1,128 @@
+import os
+from typing import Dict, List
+
+import numpy as np
+import pyarrow as pa
+import shapely
+import shapely.geometry
+
+# Bump this whenever the columns change, so old files are rebuilt rather than misread
+STORE_SCHEMA_VERSION = 1
+
+# Everything except the geometry, which is all that's needed to start the app
+SCALAR_COLUMNS = [
+    "msoa_code",
+    "msoa_name",
+    "total_dwellings",
+    "detached_or_semi",
+    "urban_area",
+    "building_coverage_area",
+    "population",
+    # Bounding box of the geometry, in WGS84
+    "min_lon",
+    "min_lat",
+    "max_lon",
+    "max_lat",
+]
+
+STORE_SCHEMA = pa.schema(
+    [
+        ("msoa_code", pa.string()),
+        ("msoa_name", pa.string()),
+        ("total_dwellings", pa.int64()),
+        ("detached_or_semi", pa.int64()),
+        ("urban_area", pa.float64()),
+        ("building_coverage_area", pa.float64()),
+        ("population", pa.int64()),
+        ("min_lon", pa.float64()),
+        ("min_lat", pa.float64()),
+        ("max_lon", pa.float64()),
+        ("max_lat", pa.float64()),
+        # The usable shape in WGS84, as WKB
+        ("geometry", pa.binary()),
+    ],
+    metadata={"schema_version": str(STORE_SCHEMA_VERSION)},
+)
+
+
+class StoreVersionError(Exception):
+    pass
+
+
+def geometry_from_geojson(geojson: dict):
+    geometries = [
+        shapely.geometry.shape(feature["geometry"]) for feature in geojson["features"]
+    ]
+    if len(geometries) == 1:
+        return geometries[0]
+    return shapely.geometry.GeometryCollection(geometries)
+
+
+def geojson_from_geometry(geometry) -> dict:
+    if geometry.geom_type == "GeometryCollection":
+        geometries = list(geometry.geoms)
+    else:
+        geometries = [geometry]
+    features = [
+        {
+            "type": "Feature",
+            "geometry": shapely.geometry.mapping(part),
+            "properties": {},
+        }
+        for part in geometries
+    ]
+    return {"type": "FeatureCollection", "features": features}
+
+
+# columns holds a list for each of SCALAR_COLUMNS, plus "geometry" as shapely
+# geometries. The bounding box columns are filled in from the geometry.
+def write_density_store(path: str, columns: Dict[str, List]):
+    geometries = np.array(columns["geometry"], dtype=object)
+    bounds = shapely.bounds(geometries).reshape(-1, 4)
+    columns = dict(columns)
+    columns["min_lon"] = bounds[:, 0]
+    columns["min_lat"] = bounds[:, 1]
+    columns["max_lon"] = bounds[:, 2]
+    columns["max_lat"] = bounds[:, 3]
+    columns["geometry"] = shapely.to_wkb(geometries).tolist()
+
+    table = pa.table(
+        {name: columns[name] for name in STORE_SCHEMA.names}, schema=STORE_SCHEMA
+    )
+    # Uncompressed Arrow IPC, so the file can be memory mapped and each column
+    # only read from disk when it's used
+    temp_path = path + ".tmp"
+    with pa.OSFile(temp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, STORE_SCHEMA) as writer:
+            writer.write_table(table)
+    # Replace the old file in one step, so readers never see half of one
+    os.replace(temp_path, path)
+
+
+class DensityStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+        version = (self.table.schema.metadata or {}).get(b"schema_version")
+        if version != str(STORE_SCHEMA_VERSION).encode():
+            raise StoreVersionError(
+                f"{path} has schema version {version}, expected "
+                f"{STORE_SCHEMA_VERSION}. Rebuild it with get_msoa_data()."
+            )
+        self.index = {
+            code: i for i, code in enumerate(self.table["msoa_code"].to_pylist())
+        }
+
+    def __len__(self):
+        return self.table.num_rows
+
+    # The scalar columns as Python lists, without touching the geometry
+    def scalars(self) -> Dict[str, List]:
+        return {name: self.table[name].to_pylist() for name in SCALAR_COLUMNS}
+
+    def geometry(self, msoa_code: str):
+        wkb = self.table["geometry"][self.index[msoa_code]].as_py()
+        return shapely.from_wkb(wkb)
+
+    def geojson(self, msoa_code: str) -> dict:
+        return geojson_from_geometry(self.geometry(msoa_code))
@@ -0,0 +1,152 @@
+from dataclasses import dataclass
+import gzip
+import hashlib
+import json
+import os
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, we just serve gzip without it
+    brotli = None
+
+ARTIFACT_FOLDER = "./build"
+HTML_FILE = "index.html"
+GEOJSON_FILE = "msoas.geojson"
+META_FILE = "meta.json"
+
+
+def content_hash(contents: bytes) -> str:
+    return hashlib.sha256(contents).hexdigest()[:32]
+
+
+# Each encoding is a different representation, so needs its own ETag
+def encoded_etag(content_hash: str, encoding: str) -> str:
+    if encoding == "identity":
+        return content_hash
+    return f"{content_hash}-{encoding}"
+
+
+# The rendered page, plus pre-compressed copies of it, so that serving a request
+# doesn't depend on how many MSOAs there are. The same for the GeoJSON of every
+# MSOA on the map.
+@dataclass
+class MapArtifact:
+    html: bytes
+    gzip: bytes
+    brotli: Optional[bytes]
+    content_hash: str
+    source_fingerprint: str
+    geojson: bytes
+    geojson_gzip: bytes
+    geojson_hash: str
+
+    def body(self, encoding: str) -> bytes:
+        if encoding == "br":
+            return self.brotli
+        if encoding == "gzip":
+            return self.gzip
+        return self.html
+
+    def etag(self, encoding: str) -> str:
+        return encoded_etag(self.content_hash, encoding)
+
+    def geojson_body(self, encoding: str) -> bytes:
+        if encoding == "gzip":
+            return self.geojson_gzip
+        return self.geojson
+
+    def geojson_etag(self, encoding: str) -> str:
+        return encoded_etag(self.geojson_hash, encoding)
+
+
+# Changes whenever the data cache is rewritten, which is when the map needs
+# rebuilding. version is for whatever is built from the cache, so that a change
+# to how it's built (e.g. how the page is rendered) also gives a new fingerprint.
+def source_fingerprint(source_path: str, version: str = "") -> str:
+    stat = os.stat(source_path)
+    key = f"{source_path}-{stat.st_size}-{stat.st_mtime_ns}-{version}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def write_map_artifact(
+    html: str, geojson: dict, fingerprint: str, folder: str = ARTIFACT_FOLDER
+) -> MapArtifact:
+    html_bytes = html.encode("utf-8")
+    geojson_bytes = json.dumps(geojson, separators=(",", ":")).encode("utf-8")
+    artifact = MapArtifact(
+        html=html_bytes,
+        # mtime=0 so the same page always compresses to the same bytes
+        gzip=gzip.compress(html_bytes, compresslevel=9, mtime=0),
+        brotli=brotli.compress(html_bytes) if brotli is not None else None,
+        content_hash=content_hash(html_bytes),
+        source_fingerprint=fingerprint,
+        geojson=geojson_bytes,
+        geojson_gzip=gzip.compress(geojson_bytes, compresslevel=9, mtime=0),
+        geojson_hash=content_hash(geojson_bytes),
+    )
+
+    os.makedirs(folder, exist_ok=True)
+    files = {HTML_FILE: artifact.html, HTML_FILE + ".gz": artifact.gzip}
+    if artifact.brotli is not None:
+        files[HTML_FILE + ".br"] = artifact.brotli
+    files[GEOJSON_FILE] = artifact.geojson
+    files[GEOJSON_FILE + ".gz"] = artifact.geojson_gzip
+    for name, contents in files.items():
+        with open(f"{folder}/{name}", "wb") as file:
+            file.write(contents)
+
+    # Written last, so a half written artifact is never picked up as complete
+    meta = {
+        "content_hash": artifact.content_hash,
+        "source_fingerprint": artifact.source_fingerprint,
+        "geojson_hash": artifact.geojson_hash,
+    }
+    with open(f"{folder}/{META_FILE}", "w") as file:
+        json.dump(meta, file)
+
+    return artifact
+
+
+# Returns None if there's no artifact yet, or it was built from an older data cache
+def load_map_artifact(
+    fingerprint: str, folder: str = ARTIFACT_FOLDER
+) -> Optional[MapArtifact]:
+    try:
+        with open(f"{folder}/{META_FILE}", "r") as file:
+            meta = json.load(file)
+        if meta["source_fingerprint"] != fingerprint:
+            return None
+
+        with open(f"{folder}/{HTML_FILE}", "rb") as file:
+            html = file.read()
+        with open(f"{folder}/{HTML_FILE}.gz", "rb") as file:
+            gzipped = file.read()
+        brotli_path = f"{folder}/{HTML_FILE}.br"
+        compressed_brotli = None
+        if brotli is not None and os.path.exists(brotli_path):
+            with open(brotli_path, "rb") as file:
+                compressed_brotli = file.read()
+        with open(f"{folder}/{GEOJSON_FILE}", "rb") as file:
+            geojson = file.read()
+        with open(f"{folder}/{GEOJSON_FILE}.gz", "rb") as file:
+            geojson_gzipped = file.read()
+    except FileNotFoundError:
+        return None
+
+    if content_hash(html) != meta["content_hash"]:
+        return None
+    # Artifacts from before the GeoJSON was served have no hash for it
+    if content_hash(geojson) != meta.get("geojson_hash"):
+        return None
+
+    return MapArtifact(
+        html=html,
+        gzip=gzipped,
+        brotli=compressed_brotli,
+        content_hash=meta["content_hash"],
+        source_fingerprint=fingerprint,
+        geojson=geojson,
+        geojson_gzip=geojson_gzipped,
+        geojson_hash=meta["geojson_hash"],
+    )
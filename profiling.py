@@ -0,0 +1,140 @@
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# Timings and counters for each stage of the density build, kept separately for
+# each MSOA. Nothing is recorded until enable() is called, so the stage() and
+# count() calls can stay in the code for good.
+
+PROFILE_REPORT_PATH = "./build/profile.json"
+# What work that isn't for any one MSOA is recorded under, e.g. the pass over
+# the buildings for all MSOAs at once
+NO_MSOA = "all"
+
+_enabled = False
+_current_msoa = NO_MSOA
+# Stages being timed, innermost last, as [name, start time, time spent in stages
+# started inside it]
+_running: List[list] = []
+_seconds: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+_counts: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+
+def enable(enabled: bool = True):
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset():
+    _running.clear()
+    _seconds.clear()
+    _counts.clear()
+
+
+# Everything recorded inside this is put down to the MSOA
+@contextmanager
+def msoa(msoa_code: str):
+    global _current_msoa
+    previous = _current_msoa
+    _current_msoa = msoa_code
+    try:
+        yield
+    finally:
+        _current_msoa = previous
+
+
+# Times the code inside it. When stages are nested, time is only counted once,
+# against the innermost stage.
+@contextmanager
+def stage(name: str):
+    if not _enabled:
+        yield
+        return
+    running = [name, time.perf_counter(), 0.0]
+    _running.append(running)
+    try:
+        yield
+    finally:
+        _running.pop()
+        elapsed = time.perf_counter() - running[1]
+        _seconds[_current_msoa][name] += elapsed - running[2]
+        if _running:
+            _running[-1][2] += elapsed
+
+
+def count(name: str, n: int = 1):
+    if _enabled:
+        _counts[_current_msoa][name] += n
+
+
+# Everything recorded so far, as plain dicts that can be pickled or saved
+def snapshot() -> dict:
+    return {
+        "seconds": {m: dict(stages) for m, stages in _seconds.items()},
+        "counts": {m: dict(counters) for m, counters in _counts.items()},
+    }
+
+
+# Hands over what's been recorded and starts again, for worker processes to send
+# their figures back to the main process with each result
+def take() -> dict:
+    taken = snapshot()
+    _seconds.clear()
+    _counts.clear()
+    return taken
+
+
+def merge(recorded: dict):
+    for msoa_code, stages in recorded["seconds"].items():
+        for name, seconds in stages.items():
+            _seconds[msoa_code][name] += seconds
+    for msoa_code, counters in recorded["counts"].items():
+        for name, n in counters.items():
+            _counts[msoa_code][name] += n
+
+
+def _totals(per_msoa: Dict[str, Dict]) -> Dict:
+    totals = defaultdict(int)
+    for values in per_msoa.values():
+        for name, value in values.items():
+            totals[name] += value
+    return dict(sorted(totals.items()))
+
+
+def report(total_seconds: Optional[float] = None) -> dict:
+    recorded = snapshot()
+    msoa_codes = sorted(set(recorded["seconds"]) | set(recorded["counts"]))
+    msoas = {
+        msoa_code: {
+            "seconds": recorded["seconds"].get(msoa_code, {}),
+            "total_seconds": sum(recorded["seconds"].get(msoa_code, {}).values()),
+            "counts": recorded["counts"].get(msoa_code, {}),
+        }
+        for msoa_code in msoa_codes
+    }
+    return {
+        "total_seconds": total_seconds,
+        # Added up over all processes, so can be more than total_seconds
+        "seconds": _totals(recorded["seconds"]),
+        "counts": _totals(recorded["counts"]),
+        # Slowest first
+        "slowest_msoas": sorted(
+            (m for m in msoa_codes if m != NO_MSOA),
+            key=lambda m: msoas[m]["total_seconds"],
+            reverse=True,
+        )[:10],
+        "msoas": msoas,
+    }
+
+
+def write_report(path: str = PROFILE_REPORT_PATH, total_seconds=None):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(report(total_seconds), file, indent=2)
@@ -0,0 +1,97 @@
+from typing import List, Sequence
+
+import numpy as np
+import shapely
+
+from census.census_table import DATA_FOLDER, NAMES_FILE, read_msoa_local_authorities
+from zoomstack.parse_zoomstack_data import boundary_store, msoa_polygon
+
+# Choosing which MSOAs to build, and splitting them into shards of neighbouring
+# MSOAs. Each shard covers a compact area, so whoever builds it only reads that
+# part of the GeoPackage, and shards can be built independently of each other.
+
+# MSOAs per shard. Big enough that most buildings read for a shard are inside
+# it, small enough that there are plenty of shards to share out.
+SHARD_SIZE = 32
+# Bits of each coordinate that go into a Morton key. Even across the whole of
+# England and Wales, 16 bits gives cells of about 10m, far smaller than any MSOA.
+MORTON_BITS = 16
+
+
+class UnknownLocalAuthorityError(ValueError):
+    pass
+
+
+class EmptySelectionError(ValueError):
+    pass
+
+
+# The MSOAs in any of the local authorities, named as in the names file (case
+# doesn't matter). A name that matches nothing is an error rather than an empty
+# build.
+def msoas_in_local_authorities(
+    msoa_codes: Sequence[str],
+    local_authorities: Sequence[str],
+    names_path: str = DATA_FOLDER + "/" + NAMES_FILE,
+) -> List[str]:
+    by_msoa = read_msoa_local_authorities(names_path)
+    known = {name.casefold() for name in by_msoa.values()}
+    unknown = [name for name in local_authorities if name.casefold() not in known]
+    if unknown:
+        raise UnknownLocalAuthorityError(
+            f"No MSOAs in {names_path} for: {', '.join(unknown)}"
+        )
+    wanted = {name.casefold() for name in local_authorities}
+    return [code for code in msoa_codes if by_msoa.get(code, "").casefold() in wanted]
+
+
+# The MSOAs whose boundary overlaps a BNG bounding box. Boundaries have to be in
+# the store already, e.g. from prefetch_brighton_shapes.
+def msoas_in_bounding_box(msoa_codes: Sequence[str], bounding_box) -> List[str]:
+    # The store's R*Tree only compares bounding boxes, so check the boundaries too
+    near = set(boundary_store().msoa_codes_in_bounding_box(bounding_box))
+    box = shapely.box(*bounding_box)
+    return [
+        code
+        for code in msoa_codes
+        if code in near and msoa_polygon(code).intersects(box)
+    ]
+
+
+def _spread_bits(values: np.ndarray) -> np.ndarray:
+    # Put a zero bit between each of the low 16 bits
+    values = values.astype(np.uint64)
+    values = (values | (values << np.uint64(8))) & np.uint64(0x00FF00FF)
+    values = (values | (values << np.uint64(4))) & np.uint64(0x0F0F0F0F)
+    values = (values | (values << np.uint64(2))) & np.uint64(0x33333333)
+    values = (values | (values << np.uint64(1))) & np.uint64(0x55555555)
+    return values
+
+
+# Z-order keys for points, (n, 2) x and y. Sorting by them keeps points that are
+# close together mostly close together in the order.
+def morton_keys(points: np.ndarray, bits: int = MORTON_BITS) -> np.ndarray:
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    low = points.min(axis=0)
+    size = (points.max(axis=0) - low).max()
+    scale = ((1 << bits) - 1) / size if size > 0 else 0
+    cells = np.floor((points - low) * scale)
+    return _spread_bits(cells[:, 0]) | (_spread_bits(cells[:, 1]) << np.uint64(1))
+
+
+# The MSOAs in Morton order of their centroids, in groups of up to shard_size
+def spatial_shards(
+    msoa_codes: Sequence[str], shard_size: int = SHARD_SIZE
+) -> List[List[str]]:
+    if not msoa_codes:
+        return []
+    centroids = shapely.get_coordinates(
+        shapely.centroid(np.array([msoa_polygon(c) for c in msoa_codes]))
+    )
+    keys = morton_keys(centroids)
+    # Ties (MSOAs in the same cell) are broken by code, so the order is stable
+    ordered = [code for _, code in sorted(zip(keys.tolist(), msoa_codes))]
+    return [
+        ordered[start : start + shard_size]
+        for start in range(0, len(ordered), shard_size)
+    ]
@@ -0,0 +1,138 @@
+import math
+import os
+import tempfile
+from typing import List, Tuple
+
+import mapbox_vector_tile
+import numpy as np
+import shapely
+import shapely.errors
+import shapely.geometry
+
+from zoomstack.crs import WEB_MERCATOR, WGS84, transform_geometries
+
+TILE_CACHE_FOLDER = "./build/tiles"
+# Bump this when tiles are cut differently, so cached tiles aren't served any more
+TILE_VERSION = 2
+LAYER_NAME = "msoas"
+# Size of the grid each tile's coordinates are rounded to
+TILE_EXTENT = 4096
+# Extra space clipped around each tile (in grid units), so outlines don't show
+# along the tile edges
+TILE_BUFFER = 64
+# How far a simplified outline may move from the original, in grid units
+SIMPLIFY_TOLERANCE = 2
+MAX_ZOOM = 20
+
+# Half the width of the Web Mercator world, in metres
+WEB_MERCATOR_HALF_WIDTH = math.pi * 6378137
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    # Bounds of a tile in Web Mercator metres, with y counting down from the top
+    tile_size = 2 * WEB_MERCATOR_HALF_WIDTH / 2**z
+    minx = -WEB_MERCATOR_HALF_WIDTH + x * tile_size
+    maxy = WEB_MERCATOR_HALF_WIDTH - y * tile_size
+    return (minx, maxy - tile_size, minx + tile_size, maxy)
+
+
+def is_valid_tile(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def to_web_mercator(geometry):
+    return transform_geometries(geometry, WGS84, WEB_MERCATOR)
+
+
+# Clipping can leave stray lines and points in a GeometryCollection, which a tile
+# can't hold, so keep only the polygons
+def polygonal_part(geometry):
+    if geometry.geom_type in ("Polygon", "MultiPolygon"):
+        return geometry
+    parts = shapely.get_parts(shapely.get_parts(geometry))
+    return shapely.geometry.MultiPolygon(
+        [part for part in parts if part.geom_type == "Polygon"]
+    )
+
+
+# Cuts MSOA shapes into vector tiles. The shapes are simplified once per zoom
+# level rather than per tile, so neighbouring tiles always agree on an outline.
+class TileSource:
+    def __init__(self, features: List[Tuple], cache_key: str):
+        # features are (WGS84 shapely geometry, properties) pairs. Clipping
+        # fails on invalid polygons, which rounding can leave in stored shapes.
+        self.geometries = shapely.make_valid(
+            to_web_mercator(
+                np.array([geometry for geometry, _ in features], dtype=object)
+            )
+        )
+        self.properties = [properties for _, properties in features]
+        self.tree = shapely.STRtree(self.geometries)
+        self.cache_key = cache_key
+        self.cache_folder = f"{TILE_CACHE_FOLDER}/{cache_key}"
+        self._simplified = {}
+
+    def simplified(self, z: int):
+        if z not in self._simplified:
+            grid_size = 2 * WEB_MERCATOR_HALF_WIDTH / 2**z / TILE_EXTENT
+            self._simplified[z] = shapely.simplify(
+                self.geometries, SIMPLIFY_TOLERANCE * grid_size, preserve_topology=True
+            )
+        return self._simplified[z]
+
+    def encode_tile(self, z: int, x: int, y: int) -> bytes:
+        bounds = tile_bounds(z, x, y)
+        buffer = TILE_BUFFER * (bounds[2] - bounds[0]) / TILE_EXTENT
+        clip_box = shapely.box(*bounds).buffer(buffer, join_style="mitre")
+
+        geometries = self.simplified(z)
+        features = []
+        for i in self.tree.query(clip_box, predicate="intersects"):
+            try:
+                clipped = shapely.intersection(geometries[i], clip_box)
+            except shapely.errors.GEOSException:
+                # Simplifying can still leave the odd invalid outline
+                clipped = shapely.intersection(
+                    shapely.make_valid(geometries[i]), clip_box
+                )
+            clipped = polygonal_part(clipped)
+            if clipped.is_empty:
+                continue
+            features.append({"geometry": clipped, "properties": self.properties[i]})
+
+        return mapbox_vector_tile.encode(
+            [{"name": LAYER_NAME, "features": features}],
+            default_options={"quantize_bounds": bounds, "extents": TILE_EXTENT},
+        )
+
+    # Tiles are cached on disk, so each one is only ever cut once
+    def tile(self, z: int, x: int, y: int) -> bytes:
+        path = f"{self.cache_folder}/{z}/{x}/{y}.pbf"
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                return file.read()
+
+        contents = self.encode_tile(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A temporary file of its own, as two requests for the same tile can be
+        # cutting it at once. Whichever is replaced last wins; they're the same.
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(handle, "wb") as file:
+            file.write(contents)
+        # mkstemp makes it readable only by us, unlike the other files in build
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+        return contents
+
+    # Cut every tile that covers the MSOAs, between the given zoom levels
+    def pregenerate(self, min_zoom: int, max_zoom: int):
+        minx, miny, maxx, maxy = shapely.total_bounds(self.geometries)
+        for z in range(min_zoom, max_zoom + 1):
+            tile_size = 2 * WEB_MERCATOR_HALF_WIDTH / 2**z
+            first_x = int((minx + WEB_MERCATOR_HALF_WIDTH) // tile_size)
+            last_x = int((maxx + WEB_MERCATOR_HALF_WIDTH) // tile_size)
+            first_y = int((WEB_MERCATOR_HALF_WIDTH - maxy) // tile_size)
+            last_y = int((WEB_MERCATOR_HALF_WIDTH - miny) // tile_size)
+            for x in range(first_x, last_x + 1):
+                for y in range(first_y, last_y + 1):
+                    self.tile(z, x, y)
@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+BOUNDARY_SERVICE_URL = "https://services1.arcgis.com/ESMARspQHYMw9BZ9/arcgis/rest/services/MSOA_Dec_2001_Boundaries_EW_BFC_2022/FeatureServer/0/query"
+CODE_FIELD = "MSOA01CD"
+
+# How many MSOAs to ask for in each where clause
+BATCH_SIZE = 100
+# Features per page. The service may send fewer, and says so with exceededTransferLimit.
+PAGE_SIZE = 1000
+# How many requests to have in flight at once
+MAX_CONCURRENCY = 4
+TIMEOUT_SECONDS = 60
+RETRIES = 5
+BACKOFF_FACTOR = 1
+
+
+class BoundaryServiceError(Exception):
+    pass
+
+
+# One pooled session for every request, retrying failed and rate limited requests
+# with exponential backoff
+def boundary_session(pool_size: int = MAX_CONCURRENCY) -> requests.Session:
+    retry = Retry(
+        total=RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+    )
+    adapter = HTTPAdapter(
+        max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# The outer ring (in WGS84) of each of the MSOAs, from as few requests as the
+# service's paging allows
+def fetch_boundary_batch(
+    session: requests.Session, msoa_ids: List[str], url: str = BOUNDARY_SERVICE_URL
+) -> Dict[str, list]:
+    codes = ",".join("'{}'".format(msoa_id) for msoa_id in msoa_ids)
+    rings = {}
+    offset = 0
+    while True:
+        # POST, so a long IN (...) clause doesn't run past URL length limits
+        response = session.post(
+            url,
+            data={
+                "where": f"{CODE_FIELD} IN ({codes})",
+                "outFields": CODE_FIELD,
+                "outSR": 4326,
+                "orderByFields": CODE_FIELD,
+                "resultOffset": offset,
+                "resultRecordCount": PAGE_SIZE,
+                "f": "json",
+            },
+            timeout=TIMEOUT_SECONDS,
+        )
+        response.raise_for_status()
+        json_data = response.json()
+        # ArcGIS reports errors in the body of a 200 response
+        if "error" in json_data:
+            raise BoundaryServiceError(json_data["error"])
+
+        features = json_data["features"]
+        for feature in features:
+            msoa_id = feature["attributes"][CODE_FIELD]
+            rings[msoa_id] = feature["geometry"]["rings"][0]
+
+        if not json_data.get("exceededTransferLimit") or not features:
+            return rings
+        offset += len(features)
+
+
+# Fetches every MSOA that is_fetched says we don't have yet, passing each batch
+# to save as soon as it arrives. A run that is stopped part way through can be
+# started again and carries on where it left off. Returns the MSOAs the service
+# didn't have.
+def prefetch_boundaries(
+    msoa_ids: List[str],
+    is_fetched: Callable[[str], bool],
+    save: Callable[[Dict[str, list]], None],
+    url: str = BOUNDARY_SERVICE_URL,
+    batch_size: int = BATCH_SIZE,
+    max_concurrency: int = MAX_CONCURRENCY,
+) -> List[str]:
+    to_fetch = [msoa_id for msoa_id in sorted(set(msoa_ids)) if not is_fetched(msoa_id)]
+    batches = [
+        to_fetch[i : i + batch_size] for i in range(0, len(to_fetch), batch_size)
+    ]
+
+    with boundary_session(max_concurrency) as session:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = [
+                executor.submit(fetch_boundary_batch, session, batch, url)
+                for batch in batches
+            ]
+            # Saved from this thread only, so save doesn't need to be thread safe
+            for future in as_completed(futures):
+                save(future.result())
+
+    return [msoa_id for msoa_id in to_fetch if not is_fetched(msoa_id)]
@@ -0,0 +1,174 @@
+import glob
+import json
+import os
+import re
+import sqlite3
+from contextlib import closing
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+
+from zoomstack.crs import BNG, WGS84, transform_coordinates
+
+# One row per MSOA with its outer ring as WKB, in both WGS84 and British National
+# Grid, plus an R*Tree over the BNG bounding boxes
+BOUNDARY_STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS boundaries (
+    id INTEGER PRIMARY KEY,
+    msoa_code TEXT NOT NULL UNIQUE,
+    wgs84 BLOB NOT NULL,
+    bng BLOB NOT NULL,
+    min_x REAL NOT NULL,
+    min_y REAL NOT NULL,
+    max_x REAL NOT NULL,
+    max_y REAL NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS boundaries_index
+    USING rtree(id, min_x, max_x, min_y, max_y);
+"""
+
+
+# Every boundary is read in one query the first time one is needed, and kept in
+# memory after that. No connection is held open in between, so the store can be
+# shared with forked worker processes.
+class BoundaryStore:
+    def __init__(self, path: str):
+        self.path = path
+        self._index: Optional[Dict[str, int]] = None
+        self._wgs84: Optional[np.ndarray] = None
+        self._bng: Optional[np.ndarray] = None
+        self._bounds: Optional[np.ndarray] = None
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path)
+        connection.executescript(BOUNDARY_STORE_SCHEMA)
+        return connection
+
+    def _load(self):
+        if self._index is not None:
+            return
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                "SELECT msoa_code, wgs84, bng FROM boundaries ORDER BY msoa_code"
+            ).fetchall()
+        self._index = {row[0]: i for i, row in enumerate(rows)}
+        self._wgs84 = shapely.from_wkb([row[1] for row in rows]).reshape(-1)
+        self._bng = shapely.from_wkb([row[2] for row in rows]).reshape(-1)
+        self._bounds = shapely.bounds(self._bng).reshape(-1, 4)
+
+    def __contains__(self, msoa_code: str) -> bool:
+        self._load()
+        return msoa_code in self._index
+
+    def __len__(self):
+        self._load()
+        return len(self._index)
+
+    def msoa_codes(self) -> List[str]:
+        self._load()
+        return list(self._index)
+
+    def wgs84(self, msoa_code: str) -> Polygon:
+        self._load()
+        return self._wgs84[self._index[msoa_code]]
+
+    def bng(self, msoa_code: str) -> Polygon:
+        self._load()
+        return self._bng[self._index[msoa_code]]
+
+    # (minx, miny, maxx, maxy) in BNG
+    def bounding_box(self, msoa_code: str) -> Tuple[float, float, float, float]:
+        self._load()
+        return tuple(self._bounds[self._index[msoa_code]].tolist())
+
+    # The MSOAs whose bounding box overlaps the given BNG one, from the R*Tree
+    def msoa_codes_in_bounding_box(self, bounding_box) -> List[str]:
+        min_x, min_y, max_x, max_y = bounding_box
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                "SELECT boundaries.msoa_code FROM boundaries_index "
+                "JOIN boundaries ON boundaries.id = boundaries_index.id "
+                "WHERE boundaries_index.min_x <= ? AND boundaries_index.max_x >= ? "
+                "AND boundaries_index.min_y <= ? AND boundaries_index.max_y >= ? "
+                "ORDER BY boundaries.msoa_code",
+                (max_x, min_x, max_y, min_y),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    # wgs84_rings and bng_rings map MSOA codes to the outer ring of each boundary.
+    # Everything is written in one transaction.
+    def add(self, wgs84_rings: Dict[str, list], bng_rings: Dict[str, list]):
+        msoa_codes = sorted(wgs84_rings)
+        # Rings have different lengths, so they can't go through shapely.polygons
+        wgs84 = np.array([Polygon(wgs84_rings[code]) for code in msoa_codes])
+        bng = np.array([Polygon(bng_rings[code]) for code in msoa_codes])
+        bounds = shapely.bounds(bng).reshape(-1, 4).tolist()
+        wgs84_wkb = shapely.to_wkb(wgs84).tolist()
+        bng_wkb = shapely.to_wkb(bng).tolist()
+
+        with closing(self.connect()) as connection:
+            with connection:
+                for i, msoa_code in enumerate(msoa_codes):
+                    min_x, min_y, max_x, max_y = bounds[i]
+                    row_id = connection.execute(
+                        "INSERT INTO boundaries "
+                        "(msoa_code, wgs84, bng, min_x, min_y, max_x, max_y) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                        "ON CONFLICT (msoa_code) DO UPDATE SET wgs84 = excluded.wgs84, "
+                        "bng = excluded.bng, min_x = excluded.min_x, "
+                        "min_y = excluded.min_y, max_x = excluded.max_x, "
+                        "max_y = excluded.max_y "
+                        "RETURNING id",
+                        (
+                            msoa_code,
+                            wgs84_wkb[i],
+                            bng_wkb[i],
+                            min_x,
+                            min_y,
+                            max_x,
+                            max_y,
+                        ),
+                    ).fetchone()[0]
+                    connection.execute(
+                        "INSERT OR REPLACE INTO boundaries_index "
+                        "(id, min_x, max_x, min_y, max_y) VALUES (?, ?, ?, ?, ?)",
+                        (row_id, min_x, max_x, min_y, max_y),
+                    )
+        # Read everything again next time, rather than patching the arrays
+        self._index = None
+
+    # WGS84 rings from the boundary service, converted to BNG here
+    def add_wgs84(self, wgs84_rings: Dict[str, list]):
+        bng_rings = {
+            msoa_code: transform_coordinates(ring, WGS84, BNG)
+            for msoa_code, ring in wgs84_rings.items()
+        }
+        self.add(wgs84_rings, bng_rings)
+
+
+# Copies the brighton_{code}.json and msoa_{code}_bng.json files written by older
+# versions into the store. Where there's no BNG file it's converted from WGS84.
+def migrate_json_boundaries(store: BoundaryStore, folder: str) -> int:
+    wgs84_rings = {}
+    bng_rings = {}
+    for path in glob.glob(folder + "/brighton_*.json"):
+        match = re.fullmatch(r"brighton_(\w+)\.json", os.path.basename(path))
+        msoa_code = match.group(1)
+        with open(path, "r") as file:
+            wgs84_rings[msoa_code] = json.load(file)
+        bng_path = folder + "/msoa_{msoa}_bng.json".format(msoa=msoa_code)
+        if os.path.exists(bng_path):
+            with open(bng_path, "r") as file:
+                bng_rings[msoa_code] = json.load(file)
+
+    have_bng = {code: wgs84_rings[code] for code in bng_rings}
+    if have_bng:
+        store.add(have_bng, bng_rings)
+    need_bng = {
+        code: ring for code, ring in wgs84_rings.items() if code not in bng_rings
+    }
+    if need_bng:
+        store.add_wgs84(need_bng)
+    return len(wgs84_rings)
@@ -0,0 +1,40 @@
+import functools
+
+import numpy as np
+import pyproj
+import shapely
+
+BNG = "EPSG:27700"  # British National Grid, which Zoomstack uses
+WGS84 = "EPSG:4326"  # Latitude and longitude, for the boundary service and maps
+WEB_MERCATOR = "EPSG:3857"  # For map tiles
+
+
+# Making a Transformer is far slower than using one, so each process makes one
+# per pair of CRSs and keeps it. Coordinates are always (x, y), i.e. (lon, lat).
+@functools.lru_cache(maxsize=None)
+def transformer(from_crs: str, to_crs: str) -> pyproj.Transformer:
+    return pyproj.Transformer.from_crs(from_crs, to_crs, always_xy=True)
+
+
+# coordinates is anything that makes an (n, 2) array, e.g. a list of (x, y) pairs
+def transform_coordinates(coordinates, from_crs: str, to_crs: str) -> np.ndarray:
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+    x, y = transformer(from_crs, to_crs).transform(coordinates[:, 0], coordinates[:, 1])
+    return np.column_stack([x, y])
+
+
+# Works on a single shapely geometry or an array of them, transforming every
+# coordinate of every geometry in one call
+def transform_geometries(geometries, from_crs: str, to_crs: str):
+    return shapely.transform(
+        geometries,
+        lambda coordinates: transform_coordinates(coordinates, from_crs, to_crs),
+    )
+
+
+def bng_to_wgs84(geometries):
+    return transform_geometries(geometries, BNG, WGS84)
+
+
+def wgs84_to_bng(geometries):
+    return transform_geometries(geometries, WGS84, BNG)
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+from typing import List, Optional
+
+import fiona
+import numpy as np
+
+from zoomstack.parse_zoomstack_data import (
+    NATIONAL_GEOPACKAGE_PATH,
+    REGIONAL_GEOPACKAGE_PATH,
+    ZOOMSTACK_LAYERS,
+    disjoint_bounding_boxes,
+    get_msoa_bounding_box,
+    region_metadata_path,
+    use_geopackage,
+)
+
+# Extra space kept around each MSOA's bounding box, in metres, so features that
+# cross the edge of a box still come out whole
+REGION_MARGIN = 500
+# Features written to the extract at a time
+WRITE_BATCH_SIZE = 10_000
+
+
+# Copies the Zoomstack layers we use, cut down to the area around the given
+# MSOAs, from the national GeoPackage to a much smaller one. GDAL gives the new
+# GeoPackage an R-tree for each layer, so bbox queries on it stay fast.
+#
+# Nearby MSOAs share one box, but MSOAs far apart (e.g. different cities) get
+# separate boxes rather than one box covering everything in between.
+def extract_region(
+    msoa_ids: List[str],
+    output_path: str = REGIONAL_GEOPACKAGE_PATH,
+    source_path: str = NATIONAL_GEOPACKAGE_PATH,
+    margin: float = REGION_MARGIN,
+) -> List[tuple]:
+    # Always read from the national file, even if there's already an extract
+    use_geopackage(source_path)
+    msoa_boxes = np.array([get_msoa_bounding_box(msoa_id) for msoa_id in msoa_ids])
+    msoa_boxes += [-margin, -margin, margin, margin]
+    bounding_boxes = disjoint_bounding_boxes(msoa_boxes)
+
+    # GDAL wants the .gpkg extension
+    temp_path = os.path.splitext(output_path)[0] + ".tmp.gpkg"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    for layer_name in ZOOMSTACK_LAYERS:
+        with fiona.open(source_path, layer=layer_name) as source:
+            # The boxes don't overlap, but a feature can cross from one to another
+            feature_ids = set()
+            with fiona.open(
+                temp_path,
+                "w",
+                driver="GPKG",
+                layer=layer_name,
+                crs=source.crs,
+                schema=source.schema,
+            ) as output:
+                batch = []
+                for bbox in bounding_boxes:
+                    for feature in source.filter(bbox=bbox):
+                        if feature.id in feature_ids:
+                            continue
+                        feature_ids.add(feature.id)
+                        batch.append(feature)
+                        if len(batch) == WRITE_BATCH_SIZE:
+                            output.writerecords(batch)
+                            batch = []
+                if batch:
+                    output.writerecords(batch)
+        print(f"{layer_name}: {len(feature_ids)} features")
+
+    os.replace(temp_path, output_path)
+    with open(region_metadata_path(output_path), "w") as file:
+        json.dump(
+            {
+                "source": source_path,
+                "margin": margin,
+                "msoa_codes": sorted(msoa_ids),
+                "bounding_boxes": [list(bbox) for bbox in bounding_boxes],
+            },
+            file,
+            indent=2,
+        )
+
+    use_geopackage(output_path)
+    return bounding_boxes
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Cut the Zoomstack layers down to the area around some MSOAs"
+    )
+    parser.add_argument(
+        "msoa_codes", nargs="*", help="MSOAs to extract (default: every census MSOA)"
+    )
+    parser.add_argument("--margin", type=float, default=REGION_MARGIN)
+    parser.add_argument("--output", default=REGIONAL_GEOPACKAGE_PATH)
+    parser.add_argument("--source", default=NATIONAL_GEOPACKAGE_PATH)
+    options = parser.parse_args(args)
+
+    msoa_codes = options.msoa_codes
+    if not msoa_codes:
+        from census.census_table import load_census_table
+
+        msoa_codes = load_census_table().msoa_codes
+
+    bounding_boxes = extract_region(
+        msoa_codes, options.output, options.source, options.margin
+    )
+    print(f"Extracted {len(bounding_boxes)} area(s) to {options.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,103 +1,243 @@
+import atexit
+import functools
+import hashlib
+import itertools
 import json
-from rasterio.warp import transform_geom
 import os
 import random
 import time
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import fiona.model
 from fiona.crs import from_epsg
 import geopandas as gpd
 import fiona
-import pyproj
-import requests
+import numpy as np
+import shapely
+import shapely.geometry
+import shapely.wkb
+
+import profiling
 from shapely.geometry import Polygon, MultiPolygon
 
+from zoomstack.boundary_fetch import (
+    BATCH_SIZE,
+    BOUNDARY_SERVICE_URL,
+    MAX_CONCURRENCY,
+    BoundaryServiceError,
+    boundary_session,
+    fetch_boundary_batch,
+    prefetch_boundaries,
+)
+from zoomstack.crs import bng_to_wgs84
+from zoomstack.boundary_store import BoundaryStore, migrate_json_boundaries
+from zoomstack.zoomstack_reader import ZoomstackReader
+
 ZOOMSTACK_FOLDER = "zoomstack"
 
 
 # Provide the path to your GeoPackage file
-geopackage_path = ZOOMSTACK_FOLDER + "/OS_Open_Zoomstack.gpkg"
+NATIONAL_GEOPACKAGE_PATH = ZOOMSTACK_FOLDER + "/OS_Open_Zoomstack.gpkg"
+# The cut down copy made by zoomstack/extract_region.py, which is used instead
+# whenever it exists
+REGIONAL_GEOPACKAGE_PATH = ZOOMSTACK_FOLDER + "/zoomstack_region.gpkg"
+
+# Every MSOA boundary we've fetched, in WGS84 and BNG
+BOUNDARY_STORE_PATH = ZOOMSTACK_FOLDER + "/msoa_boundaries.sqlite"
+
+# Usable shapes are cached here as WKB, one folder per version of the Zoomstack file
+USABLE_SHAPE_CACHE_FOLDER = ZOOMSTACK_FOLDER + "/usable_shapes"
+# Bump this when the way usable shapes are calculated changes
+USABLE_SHAPE_CACHE_VERSION = 2
+# Simplified copies of the usable shapes are cached next to the full resolution
+# ones, at each of these tolerances (in metres)
+SIMPLIFY_TOLERANCES = {"full": 0, "fine": 1, "medium": 5, "coarse": 25}
+# Which of those the map is given, and how many decimal places of latitude and
+# longitude it gets (6 is about 10cm)
+GEOJSON_LEVEL = "fine"
+GEOJSON_PRECISION = 6
+# Bump this when the GeoJSON made for the map changes, so incremental builds
+# make it again
+GEOJSON_VERSION = 2
+
+
+ZOOMSTACK_LAYERS = ["local_buildings", "national_parks", "greenspace", "woodland"]
+
+
+class OutsideRegionError(Exception):
+    pass
+
+
+def default_geopackage_path() -> str:
+    if os.path.exists(REGIONAL_GEOPACKAGE_PATH):
+        return REGIONAL_GEOPACKAGE_PATH
+    return NATIONAL_GEOPACKAGE_PATH
+
+
+geopackage_path = default_geopackage_path()
+
+
+# Point every query at a different GeoPackage, e.g. the national one even when
+# there's a regional extract
+def use_geopackage(path: str):
+    global geopackage_path
+    close_zoomstack_reader()
+    geopackage_path = path
+    zoomstack_region.cache_clear()
 
 
-def fetch_brighton_shape(msoa_id: str):
-    api_url_start = "https://services1.arcgis.com/ESMARspQHYMw9BZ9/arcgis/rest/services/MSOA_Dec_2001_Boundaries_EW_BFC_2022/FeatureServer/0/query?where=MSOA01CD%20%3D%20'"
-    api_url_end = "'&outFields=*&outSR=4326&f=json"
+# A regional extract records which bounding boxes it covers next to it, in the
+# same file name with .json. The national file has none and covers everything.
+def region_metadata_path(path: str) -> str:
+    return os.path.splitext(path)[0] + ".json"
 
-    # api_url_start = "https://services1.arcgis.com/ESMARspQHYMw9BZ9/arcgis/rest/services/MOSA_2021_EW_BFC_V6/FeatureServer/0/query?where=MSOA21NM%20%3D%20'BRIGHTON%20AND%20HOVE%20"
-    # api_url_end = "'&outFields=*&outSR=4326&f=json"
-    api_url = api_url_start + msoa_id + api_url_end
-    response = requests.get(api_url)
-    json_data = response.json()
-    features = json_data["features"]
-    keys = features[0].keys()
-    geometry = features[0]["geometry"]
-    rings = geometry["rings"]
-    return rings[0]
+
+@functools.lru_cache(maxsize=None)
+def zoomstack_region():
+    metadata_path = region_metadata_path(geopackage_path)
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, "r") as file:
+        metadata = json.load(file)
+    return shapely.union_all(shapely.box(*np.asarray(metadata["bounding_boxes"]).T))
+
+
+# An extract only has the features near the MSOAs it was made for, so querying
+# outside it would quietly give too few buildings and too little greenspace
+def check_in_region(msoa_bounding_box):
+    region = zoomstack_region()
+    if region is not None and not region.covers(shapely.box(*msoa_bounding_box)):
+        raise OutsideRegionError(
+            f"{msoa_bounding_box} is outside the area extracted to "
+            f"{geopackage_path}. Extract it again with these MSOAs, or call "
+            f"use_geopackage(NATIONAL_GEOPACKAGE_PATH)."
+        )
+
+
+# The reader this process queries Zoomstack through, see zoomstack_reader
+_reader: Optional[ZoomstackReader] = None
+
+
+# The process's reader, made the first time it's needed. A worker process that
+# was forked from one with a reader gets a new one of its own.
+def zoomstack_reader() -> ZoomstackReader:
+    global _reader
+    if _reader is None or _reader.pid != os.getpid() or _reader.path != geopackage_path:
+        _reader = ZoomstackReader(geopackage_path)
+    return _reader
+
+
+# Used as the initializer for worker processes, so that each worker opens the
+# GeoPackage once and keeps it open until it exits
+def open_zoomstack_reader():
+    reader = zoomstack_reader()
+    for layer_name in ZOOMSTACK_LAYERS:
+        reader.query(layer_name, (0, 0, 0, 0))
+    atexit.register(close_zoomstack_reader)
+
+
+def close_zoomstack_reader():
+    global _reader
+    if _reader is not None and _reader.pid == os.getpid():
+        _reader.close()
+    _reader = None
+
+
+@functools.lru_cache(maxsize=None)
+def boundary_store() -> BoundaryStore:
+    is_new = not os.path.exists(BOUNDARY_STORE_PATH)
+    store = BoundaryStore(BOUNDARY_STORE_PATH)
+    # The first time, bring in any per-MSOA files fetched before the store existed
+    if is_new:
+        migrate_json_boundaries(store, ZOOMSTACK_FOLDER)
+    return store
+
+
+def fetch_brighton_shape(msoa_id: str, url: str = BOUNDARY_SERVICE_URL):
+    with boundary_session(pool_size=1) as session:
+        rings = fetch_boundary_batch(session, [msoa_id], url)
+    if msoa_id not in rings:
+        raise BoundaryServiceError(f"No boundary for {msoa_id} from {url}")
+    return rings[msoa_id]
+
+
+# Fetches all the boundaries we don't have yet in a few batched requests, rather
+# than one request per MSOA. Safe to run again after an interruption, as each
+# batch is saved as it arrives and MSOAs already in the store are skipped.
+# Returns the MSOAs the service didn't have.
+def prefetch_brighton_shapes(
+    msoa_ids: List[str],
+    url: str = BOUNDARY_SERVICE_URL,
+    batch_size: int = BATCH_SIZE,
+    max_concurrency: int = MAX_CONCURRENCY,
+) -> List[str]:
+    store = boundary_store()
+    return prefetch_boundaries(
+        msoa_ids,
+        lambda msoa_id: msoa_id in store,
+        store.add_wgs84,
+        url=url,
+        batch_size=batch_size,
+        max_concurrency=max_concurrency,
+    )
 
 
 # the id is the numerical three digit string suffix on
 # https://geoportal.statistics.gov.uk/datasets/5ea68106e08146d1be20c3e690d68b4d_0/explore?location=52.448095%2C-2.489845%2C6.64&showTable=true
 
 
+# The boundary in BNG, fetching it first if it isn't in the store
+def msoa_polygon(msoa_id: str) -> Polygon:
+    with profiling.stage("boundary"):
+        store = boundary_store()
+        if msoa_id not in store:
+            profiling.count("boundary_fetches")
+            store.add_wgs84({msoa_id: fetch_brighton_shape(msoa_id)})
+        return store.bng(msoa_id)
+
+
 # This is the full shape including green space
 def fetch_brighton_shape_cached(msoa_id: str):
-    brighton_file = ZOOMSTACK_FOLDER + "/brighton_{msoa}.json".format(msoa=msoa_id)
-    if not os.path.exists(brighton_file):
-        msoa_lat_long = fetch_brighton_shape(msoa_id)
-        with open(brighton_file, "w") as file:
-            json.dump(msoa_lat_long, file)
+    return list(msoa_polygon(msoa_id).exterior.coords)
 
-    else:
-        with open(brighton_file, "r") as file:
-            msoa_lat_long = json.load(file)
-
-    # Define the BNG and WGS84 coordinate systems
-    # bng = pyproj.Proj(init="epsg:27700")  # British National Grid
-    # wgs84 = pyproj.Proj(init="epsg:4326")  # WGS84 (latitude and longitude)
-
-    # Convert the coordinates from WGS84 to BNG
-    # cache msoa_bng to a file as it takes time to convert
-    bng_path = ZOOMSTACK_FOLDER + "/msoa_{msoa}_bng.json".format(msoa=msoa_id)
-    transformer = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:27700")
-    if not os.path.exists(bng_path):
-        msoa_bng = [transformer.transform(lon, lat) for lon, lat in msoa_lat_long]
-        with open(bng_path, "w") as file:
-            json.dump(msoa_bng, file)
-    else:
-        with open(bng_path, "r") as file:
-            msoa_bng = json.load(file)
 
-    return msoa_bng
+def get_msoa_bounding_box(msoa_id: str):
+    # (minx, miny, maxx, maxy), straight from the store
+    msoa_polygon(msoa_id)
+    bounding_box = boundary_store().bounding_box(msoa_id)
+    check_in_region(bounding_box)
+    return bounding_box
 
 
-def get_msoa_bounding_box(msoa_id: str):
-    msoa_bng = fetch_brighton_shape_cached(msoa_id)
+# The buildings inside the MSOA, one at a time as they're read, so nothing has to
+# hold every building in a big MSOA at once
+def iter_buildings_for_msoa(
+    msoa_coordinates: List[Tuple], msoa_bounding_box
+) -> Iterator[fiona.model.Feature]:
+    msoa_shape = Polygon(msoa_coordinates)
+    # Prepared, as it's tested against every building near it
+    shapely.prepare(msoa_shape)
 
-    # Calculate the bounding box of the MSOA geometry
-    bbox = Polygon(msoa_bng).bounds  # (minx, miny, maxx, maxy)
-    return bbox
+    # Process only the feature records intersecting a box.
+    for feature in zoomstack_reader().features("local_buildings", msoa_bounding_box):
+        # Get the coordinates of the feature
+        feature_coords = feature["geometry"].coordinates[0]
+        # The same as the building being within the MSOA, but uses the
+        # prepared MSOA shape
+        if msoa_shape.contains(Polygon(feature_coords)):
+            yield feature
 
 
 def buildings_for_msoa(
     msoa_coordinates: List[Tuple], msoa_bounding_box
 ) -> List[fiona.model.Feature]:
-    with fiona.open(
-        ZOOMSTACK_FOLDER + "/OS_Open_Zoomstack.gpkg", layer="local_buildings"
-    ) as layer:
-        count = 0
-
-        buildings: List[fiona.model.Feature] = []
-        msoa_shape = Polygon(msoa_coordinates)
+    return list(iter_buildings_for_msoa(msoa_coordinates, msoa_bounding_box))
 
-        # Process only the feature records intersecting a box.
-        for feature in layer.filter(bbox=msoa_bounding_box):
-            # Get the coordinates of the feature
-            feature_coords = feature["geometry"].coordinates[0]
-            if Polygon(feature_coords).within(msoa_shape):
-                count += 1
-                buildings.append(feature)
 
-    return buildings
+# Groups of up to size items from any iterable, without reading further ahead
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
 
 
 # def greenspace_area_for_msoa(msoa_coordinates: List[Tuple], msoa_bounding_box) -> float:
@@ -153,16 +293,20 @@ INPUT_CRS = from_epsg(27700)
 OUTPUT_CRS = from_epsg(4326)
 
 
-def write_geojson_for_buildings(msoa_code: str, buildings: List[fiona.model.Feature]):
+# buildings can be any iterable, e.g. straight from iter_buildings_for_msoa. It's
+# read and written in batches, reprojecting each batch in one go, so memory use
+# doesn't grow with the number of buildings. Returns how many were written.
+def write_geojson_for_buildings(
+    msoa_code: str, buildings: Iterable[fiona.model.Feature]
+) -> int:
     # # Define the input coordinate reference system (CRS)
     # input_crs = from_epsg(27700)
     # # Define the output CRS (WGS84)
     # output_crs = from_epsg(4326)
-    # Get the schema from the appropriate layer
-    with fiona.open(geopackage_path, layer="local_buildings") as src:
-        # Get the schema from the input data source
-        schema = src.schema
+    # The reader keeps the layer open, so this doesn't open the GeoPackage again
+    schema = zoomstack_reader().schema("local_buildings")
 
+    count = 0
     # Create a GeoJSON file
     with fiona.open(
         "buildings_{msoa}.geojson".format(msoa=msoa_code),
@@ -172,20 +316,23 @@ def write_geojson_for_buildings(msoa_code: str, buildings: List[fiona.model.Feat
         # schema={"geometry": "Polygon", "properties": {}},
         schema=schema,
     ) as output:
-        for feature in buildings:
-            # Reproject the geometry to WGS84
-            reprojected_geom = transform_geom(
-                INPUT_CRS, OUTPUT_CRS, feature["geometry"]
+        for batch in batched(buildings, BUILDING_BATCH_SIZE):
+            # Reproject the batch's geometries to WGS84 in one go
+            reprojected_geoms = bng_to_wgs84(
+                np.array([shapely.geometry.shape(f["geometry"]) for f in batch])
             )
+            # Create new features with the reprojected geometry
+            output.writerecords(
+                {
+                    "type": "Feature",
+                    "geometry": shapely.geometry.mapping(reprojected_geom),
+                    "properties": feature["properties"],
+                }
+                for feature, reprojected_geom in zip(batch, reprojected_geoms)
+            )
+            count += len(batch)
 
-            # Create a new feature with the reprojected geometry
-            reprojected_feature = {
-                "type": "Feature",
-                "geometry": reprojected_geom,
-                "properties": feature["properties"],
-            }
-
-            output.write(reprojected_feature)
+    return count
 
 
 # def write_geojson_for_greenspaces(
@@ -219,9 +366,9 @@ def write_geojson_for_buildings(msoa_code: str, buildings: List[fiona.model.Feat
 #                 output.write(reprojected_feature)
 
 
-# TODO: Consider only including buildings in the usable area.
-# Some buildings will be in greenspace so shouldn't count towards the density.
-def total_area_for_buildings(buildings: List[fiona.model.Feature]):
+# Works with any iterable, so buildings can be streamed through without keeping
+# them
+def total_area_for_buildings(buildings: Iterable[fiona.model.Feature]):
     total_area_for_buildings = 0
     for building in buildings:
         # Calculate the area of the building
@@ -231,22 +378,118 @@ def total_area_for_buildings(buildings: List[fiona.model.Feature]):
     return total_area_for_buildings
 
 
-def usable_shape_for_msoa(msoa_id, msoa_bounding_box) -> Polygon:
-    shape = fetch_brighton_shape_cached(msoa_id)
-    polygon = Polygon(shape)
+GREENSPACE_LAYERS = ["national_parks", "greenspace", "woodland"]
+
+
+# Every greenspace polygon touching the bounding box, holes and all parts included
+def greenspace_for_bounding_box(msoa_bounding_box) -> List:
+    reader = zoomstack_reader()
+    greenspace = []
+    for layer_name in GREENSPACE_LAYERS:
+        greenspace.extend(reader.geometries(layer_name, msoa_bounding_box))
+
+    return greenspace
 
-    # Remove any of the greenspaces from the MSOA shape
-    for layer_name in ["national_parks", "greenspace", "woodland"]:
-        with fiona.open(
-            ZOOMSTACK_FOLDER + "/OS_Open_Zoomstack.gpkg", layer=layer_name
-        ) as layer:
-            for feature in layer.filter(bbox=msoa_bounding_box):
-                feature_coords = feature["geometry"].coordinates[0]
-                polygon = polygon.difference(Polygon(feature_coords))
 
+def usable_shape_for_msoa(msoa_id, msoa_bounding_box, bulk=True) -> Polygon:
+    polygon = msoa_polygon(msoa_id)
+    with profiling.stage("greenspace_query"):
+        greenspace = greenspace_for_bounding_box(msoa_bounding_box)
+
+    with profiling.stage("greenspace_subtraction"):
+        if not bulk:
+            # Remove the greenspaces from the MSOA shape one at a time. This gets
+            # slower with every step as the MSOA shape picks up more vertices.
+            for green_polygon in greenspace:
+                polygon = polygon.difference(green_polygon)
+        else:
+            # Otherwise union all the greenspace in one go, clip it to the MSOA
+            # and take a single difference
+            greenspace = np.array(greenspace, dtype=object)
+            greenspace = greenspace[shapely.intersects(greenspace, polygon)]
+            if len(greenspace) > 0:
+                all_greenspace = shapely.union_all(greenspace)
+                polygon = polygon.difference(all_greenspace.intersection(polygon))
+
+    profiling.count("usable_shape_vertices", int(shapely.get_num_coordinates(polygon)))
     return polygon
 
 
+def zoomstack_fingerprint() -> str:
+    # Hashing the contents of a multi-GB file would take longer than the work
+    # we're caching, so use its size and modification time instead
+    stat = os.stat(geopackage_path)
+    key = f"{USABLE_SHAPE_CACHE_VERSION}-{stat.st_size}-{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+# The shape depends on the boundary as well as the Zoomstack file, so a boundary
+# that changes in the store gets a new cache entry rather than the old shape
+def usable_shape_cache_path(msoa_id: str, level: str = "full") -> str:
+    return "{folder}/{fingerprint}/{msoa}-{boundary}{suffix}.wkb".format(
+        folder=USABLE_SHAPE_CACHE_FOLDER,
+        fingerprint=zoomstack_fingerprint(),
+        msoa=msoa_id,
+        boundary=boundary_digest(msoa_id)[:16],
+        suffix="" if level == "full" else "." + level,
+    )
+
+
+def read_shape_cache(cache_path: str):
+    if not os.path.exists(cache_path):
+        profiling.count("shape_cache_misses")
+        return None
+    profiling.count("shape_cache_hits")
+    with profiling.stage("deserialisation"):
+        with open(cache_path, "rb") as file:
+            return shapely.wkb.loads(file.read())
+
+
+def write_shape_cache(cache_path: str, shape):
+    with profiling.stage("serialisation"):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # Write to a temporary file first so a killed run can't leave half a shape
+        temp_path = cache_path + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(shapely.wkb.dumps(shape))
+        os.replace(temp_path, cache_path)
+
+
+# Removing the greenspace is the slowest part of the pipeline, so do it once per
+# MSOA and derive both the urban area and the GeoJSON from the cached shape
+def usable_shape_for_msoa_cached(msoa_id: str):
+    cache_path = usable_shape_cache_path(msoa_id)
+    shape = read_shape_cache(cache_path)
+    if shape is None:
+        shape = usable_shape_for_msoa(msoa_id, get_msoa_bounding_box(msoa_id))
+        write_shape_cache(cache_path, shape)
+    return shape
+
+
+# The full resolution usable shape if it's already cached, without working it
+# out or fetching anything. None if it isn't cached, or there's no GeoPackage to
+# key the cache on, e.g. where only the density cache has been copied.
+def cached_usable_shape(msoa_id: str):
+    if not os.path.exists(geopackage_path) or msoa_id not in boundary_store():
+        return None
+    return read_shape_cache(usable_shape_cache_path(msoa_id))
+
+
+# The usable shape simplified to one of SIMPLIFY_TOLERANCES, keeping its topology
+def simplified_usable_shape_cached(msoa_id: str, level: str):
+    if level == "full":
+        return usable_shape_for_msoa_cached(msoa_id)
+
+    cache_path = usable_shape_cache_path(msoa_id, level)
+    shape = read_shape_cache(cache_path)
+    if shape is None:
+        shape = usable_shape_for_msoa_cached(msoa_id)
+        with profiling.stage("simplification"):
+            shape = shape.simplify(SIMPLIFY_TOLERANCES[level], preserve_topology=True)
+        write_shape_cache(cache_path, shape)
+    return shape
+
+
 import json
 from shapely.geometry import mapping
 
@@ -276,36 +519,68 @@ def extract_multipolygon(geometry):
         return geometry
 
 
-def geometries_to_geojson(geometries):
+# Rounds every coordinate in a (nested) GeoJSON coordinates list. On its own this
+# can make outlines cross themselves, so it's only used on coordinates already
+# snapped to the grid, to drop float noise like 50.822500000000005.
+def truncate_coordinates(coordinates, precision: int):
+    if isinstance(coordinates[0], (int, float)):
+        return tuple(round(value, precision) for value in coordinates)
+    return [truncate_coordinates(part, precision) for part in coordinates]
+
+
+# tolerance (in metres) simplifies the geometries before they are reprojected,
+# and precision is the number of decimal places kept after
+def geometries_to_geojson(geometries, tolerance=None, precision=None):
     # Don't want the Lines, etc, if we had a GeometryCollection
     geometries = [extract_multipolygon(geom) for geom in geometries]
+    if tolerance:
+        geometries = [
+            polygon.simplify(tolerance, preserve_topology=True)
+            for polygon in geometries
+        ]
+    geometries = np.array(geometries, dtype=object)
+    profiling.count(
+        "geojson_vertices", int(shapely.get_num_coordinates(geometries).sum())
+    )
+    with profiling.stage("reprojection"):
+        reprojected_geoms = bng_to_wgs84(geometries)
+        if precision is not None:
+            # Snapping the geometries to the grid, rather than rounding each
+            # coordinate, keeps them valid. It needs valid geometries to start
+            # with, which simplifying doesn't always leave.
+            reprojected_geoms = shapely.set_precision(
+                shapely.make_valid(reprojected_geoms), 10.0**-precision
+            )
+            reprojected_geoms = [extract_multipolygon(g) for g in reprojected_geoms]
     features = []
 
-    for polygon in geometries:
-        # transformed_polygon = transform_geom_func(polygon)
-        reprojected_geom = transform_geom(INPUT_CRS, OUTPUT_CRS, polygon)
+    for reprojected in reprojected_geoms:
+        with profiling.stage("serialisation"):
+            reprojected_geom = shapely.geometry.mapping(reprojected)
+            if precision is not None and reprojected_geom["coordinates"]:
+                reprojected_geom["coordinates"] = truncate_coordinates(
+                    reprojected_geom["coordinates"], precision
+                )
 
         # reprojected_geometry is either a Polygon or a MultiPolygon
-
-        # geojson_geometry = mapping(reprojected_geom)
-        # geojson_geometry["crs"] = OUTPUT_CRS.to_dict()
         features.append(
             {"type": "Feature", "geometry": reprojected_geom, "properties": {}}
         )
     return features
 
 
-def geojson_for_msoa(msoa_id):
-    shape = usable_shape_for_msoa(msoa_id, get_msoa_bounding_box(msoa_id))
-    geojson_features = geometries_to_geojson([shape])
+def geojson_for_shape(shape, tolerance=None, precision=None):
+    geojson_features = geometries_to_geojson([shape], tolerance, precision)
     return {"type": "FeatureCollection", "features": geojson_features}
 
 
+def geojson_for_msoa(msoa_id, level=GEOJSON_LEVEL, precision=GEOJSON_PRECISION):
+    shape = simplified_usable_shape_cached(msoa_id, level)
+    return geojson_for_shape(shape, precision=precision)
+
+
 def write_geojson_for_msoas(msoa_ids):
-    shapes = [
-        usable_shape_for_msoa(msoa_id, get_msoa_bounding_box(msoa_id))
-        for msoa_id in msoa_ids
-    ]
+    shapes = [usable_shape_for_msoa_cached(msoa_id) for msoa_id in msoa_ids]
     geojson_features = geometries_to_geojson(shapes)
     geojson_data = {"type": "FeatureCollection", "features": geojson_features}
     with open("usable_area_all.geojson", "w") as file:
@@ -319,16 +594,138 @@ def urban_area_for_msoa(msoa_id) -> float:
     # polygon = Polygon(shape)
     # total_area = polygon.area
     # return total_area
-    shape: MultiPolygon = usable_shape_for_msoa(msoa_id, get_msoa_bounding_box(msoa_id))
+    shape: MultiPolygon = usable_shape_for_msoa_cached(msoa_id)
     return shape.area
 
 
+# Building area inside the MSOA's usable shape, see add_building_coverage
 def building_area_for_msoa(msoa_id):
-    buildings = buildings_for_msoa(
-        fetch_brighton_shape_cached(msoa_id),
-        get_msoa_bounding_box(msoa_id),
+    bounding_box = get_msoa_bounding_box(msoa_id)
+    shapes = np.array([usable_shape_for_msoa_cached(msoa_id)], dtype=object)
+    totals = np.zeros(1)
+    for buildings in building_batches(bounding_box):
+        add_building_coverage(totals, shapes, buildings)
+    return float(totals[0])
+
+
+# Hash of the boundary, which everything else about the MSOA comes from
+def boundary_digest(msoa_id: str) -> str:
+    msoa_polygon(msoa_id)
+    wgs84 = boundary_store().wgs84(msoa_id)
+    return hashlib.sha1(shapely.to_wkb(wgs84)).hexdigest()
+
+
+# Hash of every Zoomstack feature we use inside the bounding box. This reads the
+# features but doesn't do any geometry work, so it's much cheaper than a rebuild.
+def zoomstack_digest_for_bounding_box(msoa_bounding_box) -> str:
+    reader = zoomstack_reader()
+    digest = hashlib.sha1()
+    for layer_name in ZOOMSTACK_LAYERS:
+        feature_ids, geometries = reader.query(layer_name, msoa_bounding_box)
+        digest.update(layer_name.encode())
+        digest.update(feature_ids.tobytes())
+        for wkb in shapely.to_wkb(geometries):
+            digest.update(wkb)
+    return digest.hexdigest()
+
+
+# How many buildings to test against the MSOA shapes at a time
+BUILDING_BATCH_SIZE = 10_000
+
+
+# The buildings in the box, a batch at a time so a big box never has to be held
+# in memory at once. Reading them is timed as the building_query stage.
+def building_batches(bbox) -> Iterator[np.ndarray]:
+    batches = zoomstack_reader().geometry_batches("local_buildings", bbox)
+    while True:
+        with profiling.stage("building_query"):
+            buildings = next(batches, None)
+        if buildings is None:
+            return
+        yield buildings
+
+
+# Merge any overlapping bounding boxes so that no building gets read twice
+def disjoint_bounding_boxes(bounding_boxes) -> List[Tuple]:
+    boxes = shapely.box(*np.asarray(bounding_boxes).T)
+    while True:
+        parts = shapely.get_parts(shapely.union_all(boxes))
+        if len(parts) == len(boxes):
+            return [tuple(box.bounds) for box in boxes]
+        boxes = shapely.envelope(parts)
+
+
+# Bump this when the way building coverage is measured changes, so incremental
+# builds work it out again
+BUILDING_COVERAGE_VERSION = 2
+
+
+# Adds the footprint area of the buildings that lies inside each of the shapes to
+# totals, clipping buildings that cross a shape's edge. Only the outer ring of
+# each building counts.
+#
+# Most buildings are wholly inside or wholly outside every shape, so the
+# predicates, run against prepared shapes, sort them out cheaply. The ones inside
+# just add their area, and only those crossing an edge are intersected.
+def add_building_coverage(totals: np.ndarray, shapes: np.ndarray, buildings):
+    with profiling.stage("building_coverage"):
+        shapely.prepare(shapes)
+        # A MultiPolygon building counts each of its parts. Areas are only
+        # added up per shape, so the parts don't need to know their building.
+        parts = shapely.get_parts(buildings)
+        parts = parts[shapely.get_type_id(parts) == shapely.GeometryType.POLYGON]
+        buildings = shapely.polygons(shapely.get_exterior_ring(parts))
+        for start in range(0, len(buildings), BUILDING_BATCH_SIZE):
+            batch = buildings[start : start + BUILDING_BATCH_SIZE]
+            # Querying a tree of the buildings with the shapes tests each
+            # shape, prepared, against the buildings near it
+            shape_index, building_index = shapely.STRtree(batch).query(
+                shapes, predicate="intersects"
+            )
+            pair_shapes = shapes[shape_index]
+            pair_buildings = batch[building_index]
+            areas = shapely.area(pair_buildings)
+            crossing = ~shapely.contains(pair_shapes, pair_buildings)
+            profiling.count("buildings_clipped", int(crossing.sum()))
+            # make_valid so one self-intersecting building can't stop the build
+            areas[crossing] = shapely.area(
+                shapely.intersection(
+                    shapely.make_valid(pair_buildings[crossing]),
+                    pair_shapes[crossing],
+                )
+            )
+            np.add.at(totals, shape_index, areas)
+
+
+# Building area inside the usable shape of many MSOAs, in one pass over the
+# buildings layer rather than reading the buildings near each MSOA again for
+# every one of its neighbours
+def building_areas_for_msoas(msoa_ids: List[str]) -> Dict[str, float]:
+    msoa_shapes = np.array(
+        [msoa_polygon(msoa_id) for msoa_id in msoa_ids], dtype=object
+    )
+    usable_shapes = np.array(
+        [usable_shape_for_msoa_cached(msoa_id) for msoa_id in msoa_ids], dtype=object
     )
-    return total_area_for_buildings(buildings)
+    totals = np.zeros(len(msoa_ids))
+
+    bounding_boxes = disjoint_bounding_boxes(shapely.bounds(msoa_shapes))
+    for bbox in bounding_boxes:
+        check_in_region(bbox)
+
+    for i, bbox in enumerate(bounding_boxes):
+        # Boxes that only touch at a corner aren't merged, so a building there
+        # is read for both. It's only counted for the first.
+        earlier = None
+        if i > 0:
+            earlier = shapely.STRtree(shapely.box(*np.asarray(bounding_boxes[:i]).T))
+        for buildings in building_batches(bbox):
+            if earlier is not None:
+                already_read = earlier.query(buildings, predicate="intersects")[0]
+                buildings = np.delete(buildings, np.unique(already_read))
+            add_building_coverage(totals, usable_shapes, buildings)
+
+    return dict(zip(msoa_ids, totals.tolist()))
 
 
 def main_function():
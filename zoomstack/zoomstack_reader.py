@@ -0,0 +1,143 @@
+import os
+import sqlite3
+import urllib.parse
+from typing import Dict, Iterator, Optional, Tuple
+
+import fiona
+import fiona.model
+import numpy as np
+import shapely
+
+import profiling
+
+# Size of the envelope in a GeoPackage geometry header, indexed by bits 1-3 of
+# its flags byte
+ENVELOPE_SIZES = [0, 32, 48, 48, 64]
+# How many features query_batches reads from SQLite at a time
+QUERY_BATCH_SIZE = 10_000
+
+
+def geometries_from_gpkg(blobs) -> np.ndarray:
+    # A GeoPackage geometry is an 8 byte header and an optional envelope in
+    # front of standard WKB, so skip those and parse all the WKB in one call
+    wkb = [blob[8 + ENVELOPE_SIZES[(blob[3] >> 1) & 7] :] for blob in blobs]
+    return shapely.from_wkb(np.array(wkb, dtype=object))
+
+
+# Keeps the GeoPackage open for as long as it's needed, rather than opening it
+# again for every query. Each process needs its own, as neither SQLite nor GDAL
+# handles can be shared after a fork.
+#
+#     with ZoomstackReader(geopackage_path) as reader:
+#         greenspace = reader.geometries("greenspace", bbox)
+#
+# Bounding box queries go straight to the GeoPackage's R-tree and give back
+# arrays of shapely geometries, without making a fiona Feature for each one.
+# features() is still there for code that wants the properties too.
+class ZoomstackReader:
+    def __init__(self, path: str):
+        self.path = path
+        self.pid = os.getpid()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._tables: Dict[str, Tuple[str, str]] = {}
+        self._collections: Dict[str, fiona.Collection] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        for collection in self._collections.values():
+            collection.close()
+        self._collections.clear()
+
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            profiling.count("geopackage_opens")
+            uri = "file:" + urllib.parse.quote(os.path.abspath(self.path))
+            self._connection = sqlite3.connect(uri + "?mode=ro", uri=True)
+        return self._connection
+
+    # The names of the feature id and geometry columns of a layer
+    def _table(self, layer_name: str) -> Tuple[str, str]:
+        if layer_name not in self._tables:
+            connection = self.connection()
+            row = connection.execute(
+                "SELECT column_name FROM gpkg_geometry_columns WHERE table_name = ?",
+                (layer_name,),
+            ).fetchone()
+            if row is None:
+                raise KeyError(f"No layer {layer_name} in {self.path}")
+            fid_column = next(
+                column[1]
+                for column in connection.execute(f'PRAGMA table_info("{layer_name}")')
+                if column[5]
+            )
+            self._tables[layer_name] = (fid_column, row[0])
+        return self._tables[layer_name]
+
+    # Feature ids and geometries, in feature id order, of everything in the layer
+    # that intersects the box, batch_size features at a time. That's the same
+    # set fiona's filter(bbox=...) gives. Only one batch is in memory at once, so
+    # this is the one to use for boxes with a lot in them.
+    def query_batches(
+        self, layer_name: str, bbox, batch_size: int = QUERY_BATCH_SIZE
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        fid_column, geometry_column = self._table(layer_name)
+        min_x, min_y, max_x, max_y = bbox
+        cursor = self.connection().execute(
+            f'SELECT "{fid_column}", "{geometry_column}" FROM "{layer_name}" '
+            f'WHERE "{fid_column}" IN (SELECT id FROM '
+            f'"rtree_{layer_name}_{geometry_column}" '
+            "WHERE minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ?) "
+            f'AND "{geometry_column}" IS NOT NULL '
+            f'ORDER BY "{fid_column}"',
+            (max_x, min_x, max_y, min_y),
+        )
+        profiling.count("bbox_queries")
+        box = shapely.box(*bbox)
+        try:
+            while rows := cursor.fetchmany(batch_size):
+                profiling.count("features_scanned", len(rows))
+                ids = np.array([row[0] for row in rows], dtype=np.int64)
+                geometries = geometries_from_gpkg([row[1] for row in rows])
+                # The R-tree only compares bounding boxes, so drop anything that
+                # only comes near the box
+                touching = shapely.intersects(geometries, box)
+                yield ids[touching], geometries[touching]
+        finally:
+            cursor.close()
+
+    # All of query_batches at once
+    def query(self, layer_name: str, bbox) -> Tuple[np.ndarray, np.ndarray]:
+        batches = list(self.query_batches(layer_name, bbox))
+        if not batches:
+            return np.array([], dtype=np.int64), np.array([], dtype=object)
+        ids, geometries = zip(*batches)
+        return np.concatenate(ids), np.concatenate(geometries)
+
+    def geometry_batches(
+        self, layer_name: str, bbox, batch_size: int = QUERY_BATCH_SIZE
+    ) -> Iterator[np.ndarray]:
+        for _, geometries in self.query_batches(layer_name, bbox, batch_size):
+            yield geometries
+
+    def geometries(self, layer_name: str, bbox) -> np.ndarray:
+        return self.query(layer_name, bbox)[1]
+
+    def collection(self, layer_name: str) -> fiona.Collection:
+        if layer_name not in self._collections:
+            profiling.count("geopackage_opens")
+            self._collections[layer_name] = fiona.open(self.path, layer=layer_name)
+        return self._collections[layer_name]
+
+    def schema(self, layer_name: str) -> dict:
+        return self.collection(layer_name).schema
+
+    def features(self, layer_name: str, bbox) -> Iterator[fiona.model.Feature]:
+        return self.collection(layer_name).filter(bbox=bbox)